@@ -0,0 +1,81 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Micro-benchmarks for the 'error' module. Run them from the project's root folder:
+#
+#       python benchmarks/error/bench_catch_errors.py
+
+import sys
+import timeit
+import asyncio
+
+sys.path.append(".")  # noqa # Adds higher directory to python modules path.
+
+from src.puffy.error import catch_errors, async_catch_errors, StackedException
+
+NUMBER = 20000
+
+
+def _report(name, stmt, number=NUMBER, calls=None):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<40} {best / (calls or number) * 1e6:8.2f} µs/call")
+
+
+def bench_catch_errors():
+    def succeed():
+        return "yes"
+
+    def fail():
+        raise Exception("Failed")
+
+    safe_succeed = catch_errors(succeed)
+    safe_fail = catch_errors("Should fail")(fail)
+
+    _report("bare call", succeed)
+    _report("catch_errors success", safe_succeed)
+    _report("catch_errors failure", safe_fail)
+
+
+def bench_async_catch_errors():
+    async def succeed():
+        return "yes"
+
+    async def fail():
+        raise Exception("Failed")
+
+    safe_succeed = async_catch_errors(succeed)
+    safe_fail = async_catch_errors("Should fail")(fail)
+
+    def run(fn):
+        async def loop():
+            for _ in range(NUMBER):
+                await fn()
+
+        return lambda: asyncio.run(loop())
+
+    _report("bare await", run(succeed), number=1, calls=NUMBER)
+    _report("async_catch_errors success", run(safe_succeed), number=1, calls=NUMBER)
+    _report("async_catch_errors failure", run(safe_fail), number=1, calls=NUMBER)
+
+
+def bench_stacking():
+    # Same wrapping as a chain of nested 'catch_errors("...")' functions, without
+    # the call stack depth.
+    for depth in [10, 100, 1000]:
+
+        def chain():
+            err = StackedException(Exception("Failed"))
+            for i in range(depth):
+                err = StackedException(Exception(f"Level {i}"), err)
+            return err
+
+        _report(f"StackedException chain (depth {depth})", chain, number=50)
+
+
+if __name__ == "__main__":
+    bench_catch_errors()
+    bench_async_catch_errors()
+    bench_stacking()
@@ -0,0 +1,219 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Micro-benchmarks for the 'log' module. Run them from the project's root folder:
+#
+#       python benchmarks/log/bench_log.py
+
+import sys
+import os
+import json
+import timeit
+
+sys.path.append(".")  # noqa # Adds higher directory to python modules path.
+
+from src.puffy.log import (
+    log,
+    enable_async,
+    disable_async,
+    flush,
+    set_sink,
+    FileSink,
+    set_context,
+    reset_context,
+    log_context,
+    bind,
+    set_level,
+    set_rate_limit,
+    clear_rate_limits,
+    enable_metric_aggregation,
+    disable_metric_aggregation,
+    timed,
+)
+
+NUMBER = 20000
+
+
+def _noop(msg):
+    pass
+
+
+def _report(name, stmt, number=NUMBER):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<40} {best / number * 1e6:8.2f} µs/call")
+
+
+def bench_meta():
+    os.environ["LOG_META"] = ""
+    _report(
+        "log() without LOG_META",
+        lambda: log(message="hello", code="bench", print_mock=_noop),
+    )
+
+    os.environ["LOG_META"] = json.dumps(
+        {
+            "api_name": "bench",
+            "region": "ap-southeast-2",
+            "version": "1.2.3",
+            "host": {"name": "bench-01", "az": "ap-southeast-2a"},
+        }
+    )
+    _report(
+        "log() with LOG_META",
+        lambda: log(message="hello", code="bench", print_mock=_noop),
+    )
+    os.environ["LOG_META"] = ""
+
+
+class _DevNull:
+    def write(self, chunk):
+        pass
+
+    def flush(self):
+        pass
+
+
+def bench_async():
+    stdout = sys.stdout
+    sys.stdout = _DevNull()
+    try:
+        sync_best = min(
+            timeit.repeat(lambda: log(message="hello"), number=NUMBER, repeat=5)
+        )
+        enable_async(queue_size=NUMBER * 2)
+        async_best = min(
+            timeit.repeat(lambda: log(message="hello"), number=NUMBER, repeat=5)
+        )
+        flush()
+        disable_async()
+    finally:
+        sys.stdout = stdout
+
+    print(f"{'log() to stdout (sync)':<40} {sync_best / NUMBER * 1e6:8.2f} µs/call")
+    print(f"{'log() to stdout (async)':<40} {async_best / NUMBER * 1e6:8.2f} µs/call")
+
+
+def bench_sinks():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        _report("log() with print", lambda: log(message="hello"))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    set_sink(FileSink(os.devnull))
+    _report("log() with FileSink", lambda: log(message="hello"))
+    set_sink(FileSink(os.devnull, buffer_size=65536))
+    _report("log() with buffered FileSink", lambda: log(message="hello"))
+    set_sink(None).close()
+
+
+def bench_context():
+    set_context(**{f"key_{i}": f"value_{i}" for i in range(10)})
+    _report(
+        "log() with a 10 keys context",
+        lambda: log(message="hello", code="bench", print_mock=_noop),
+    )
+
+    def scoped():
+        with log_context(request_id="1234"):
+            pass
+
+    _report("log_context() enter/exit", scoped)
+    reset_context()
+
+
+def bench_bind():
+    static = {f"key_{i}": f"value_{i}" for i in range(10)}
+    _report(
+        "log() with 10 static keys",
+        lambda: log(
+            message="hello", code="bench", op_id="1234", print_mock=_noop, **static
+        ),
+    )
+
+    logger = bind(code="bench", op_id="1234", print_mock=_noop, **static)
+    _report("bind().log() with 10 static keys", lambda: logger.log(message="hello"))
+
+
+def bench_level():
+    set_level("WARN")
+    _report(
+        "log() filtered out by the level",
+        lambda: log(message="hello", data={"hello": "world"}, print_mock=_noop),
+    )
+    set_level()
+
+
+def bench_rate_limit():
+    _report(
+        "log() without rate limits",
+        lambda: log(message="hello", code="cold", print_mock=_noop),
+    )
+    set_rate_limit(code="hot", rate=1, burst=1, summary_interval=3600)
+    _report(
+        "log() with a limit on another code",
+        lambda: log(message="hello", code="cold", print_mock=_noop),
+    )
+    _report(
+        "log() suppressed by a rate limit",
+        lambda: log(message="hello", code="hot", print_mock=_noop),
+    )
+    clear_rate_limits()
+
+
+def bench_metrics():
+    _report("log(time=...)", lambda: log(code="latency", time=12.5, print_mock=_noop))
+    enable_metric_aggregation(interval=None, dimensions=["service"])
+    _report(
+        "log(time=...) aggregated",
+        lambda: log(code="latency", time=12.5, service="api"),
+    )
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        disable_metric_aggregation()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_timed():
+    def bare():
+        pass
+
+    decorated = timed(code="bench")(bare)
+    set_level("ERROR")
+    _report("bare function call", bare)
+    _report("@timed function call (level muted)", decorated)
+
+    def block():
+        with timed(code="bench"):
+            pass
+
+    _report("with timed() (level muted)", block)
+
+    timer = timed(code="bench")
+
+    def reused():
+        with timer:
+            pass
+
+    _report("with a reused timed() (level muted)", reused)
+    set_level()
+
+
+if __name__ == "__main__":
+    bench_meta()
+    bench_async()
+    bench_sinks()
+    bench_context()
+    bench_bind()
+    bench_level()
+    bench_rate_limit()
+    bench_metrics()
+    bench_timed()
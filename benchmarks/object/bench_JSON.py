@@ -0,0 +1,174 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Micro-benchmarks for the 'object' module. Run them from the project's root folder:
+#
+#       python benchmarks/object/bench_JSON.py
+
+import sys
+import json
+import timeit
+
+sys.path.append(".")  # noqa # Adds higher directory to python modules path.
+
+from src.puffy.object import (
+    JSON,
+    dotProps,
+    compile_path,
+    compile_paths,
+    extract_columns,
+    unwrap,
+    JSONView,
+)
+
+NUMBER = 100000
+
+
+def _report(name, stmt, number=NUMBER, calls=None):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<40} {best / (calls or number) * 1e6:8.2f} µs/call")
+
+
+def _original_dotProps(obj, keys, set_value=None, set_mode=False):
+    # Copy of the original 'dotProps' (one 'split' per call), used as baseline.
+    if not keys or not obj or not isinstance(obj, dict) or not isinstance(keys, str):
+        return None
+
+    value = obj
+    _keys = keys.split(".")
+    keys_last_index = len(_keys) - 1
+    for idx, key in enumerate(_keys):
+        last_key = idx == keys_last_index
+        if key in value:
+            if last_key:
+                if set_mode:
+                    value[key] = set_value
+            elif not isinstance(value[key], dict):
+                value[key] = {}
+
+            value = value[key]
+        else:
+            if last_key:
+                value[key] = set_value if set_mode else None
+            else:
+                value[key] = {}
+            value = value[key]
+
+    return value
+
+
+def _document(depth):
+    keys = [f"key_{i}" for i in range(depth)]
+    obj = "value"
+    for key in reversed(keys):
+        obj = {key: obj, "other": 1}
+    return JSON(obj), ".".join(keys)
+
+
+def bench_get():
+    for depth in [1, 3, 8]:
+        obj, keys = _document(depth)
+        path = compile_path(keys)
+        _report(
+            f"original dotProps get (depth {depth})",
+            lambda: _original_dotProps(obj, keys),
+        )
+        _report(f"dotProps get (depth {depth})", lambda: dotProps(obj, keys))
+        _report(f"JSON.g (depth {depth})", lambda: obj.g(keys))
+        _report(f"compiled get (depth {depth})", lambda: path.get(obj))
+
+
+def bench_set():
+    for depth in [1, 3, 8]:
+        obj, keys = _document(depth)
+        path = compile_path(keys)
+        _report(
+            f"original dotProps set (depth {depth})",
+            lambda: _original_dotProps(obj, keys, 1, True),
+        )
+        _report(f"dotProps set (depth {depth})", lambda: dotProps(obj, keys, 1, True))
+        _report(f"JSON.s (depth {depth})", lambda: obj.s(keys, 1))
+        _report(f"compiled set (depth {depth})", lambda: path.set(obj, 1))
+
+
+def bench_many():
+    event = JSON(
+        {
+            "request": {
+                "headers": {f"header_{i}": i for i in range(20)},
+                "query": {f"param_{i}": i for i in range(20)},
+            }
+        }
+    )
+    paths = [f"request.headers.header_{i}" for i in range(20)] + [
+        f"request.query.param_{i}" for i in range(20)
+    ]
+    trie = compile_paths(paths)
+    values = {path: 0 for path in paths}
+    # Reported per path.
+    number = NUMBER // 20
+    options = dict(number=number, calls=number * len(paths))
+    _report("JSON.g (40 paths)", lambda: [event.g(p) for p in paths], **options)
+    _report("JSON.g_many (40 paths)", lambda: event.g_many(paths), **options)
+    _report("compiled trie get (40 paths)", lambda: trie.get(event), **options)
+    _report("JSON.s (40 paths)", lambda: [event.s(p, 0) for p in paths], **options)
+    _report("JSON.s_many (40 paths)", lambda: event.s_many(values), **options)
+
+
+def bench_columns():
+    documents = [
+        {"id": i, "user": {"name": f"user_{i}"}, "items": [{"price": i}, {"price": 1}]}
+        for i in range(10000)
+    ]
+    paths = ["id", "user.name", "items.0.price", "items.*.price"]
+    getters = [compile_path(p) for p in paths]
+
+    def loop():
+        return {p.path: [p.get(d) for d in documents] for p in getters}
+
+    def columns(paths):
+        return lambda: list(extract_columns(documents, paths, numpy=False))
+
+    options = dict(number=10, calls=10 * len(documents))
+    _report("compiled get per field (4 paths)", loop, **options)
+    _report("extract_columns (4 paths)", columns(paths), **options)
+    _report("extract_columns (3 paths, no wildcard)", columns(paths[:3]), **options)
+
+
+def bench_view():
+    payload = {
+        "records": [{"id": i, "user": {"name": f"user_{i}"}} for i in range(10000)],
+        "meta": {"page": {"size": 10000}},
+    }
+
+    def deep_convert(value):
+        if isinstance(value, dict):
+            return JSON({k: deep_convert(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return [deep_convert(v) for v in value]
+        return value
+
+    _report(
+        "deep JSON conversion + read",
+        lambda: deep_convert(payload)["meta"]["page"]["size"],
+        number=20,
+    )
+    _report("JSONView + read", lambda: JSONView(payload)["meta"]["page"]["size"])
+    view = JSONView(payload)
+    _report(
+        "json.dumps(view, default=unwrap)",
+        lambda: json.dumps(view, default=unwrap),
+        number=20,
+    )
+    _report("json.dumps(dict)", lambda: json.dumps(payload), number=20)
+
+
+if __name__ == "__main__":
+    bench_get()
+    bench_set()
+    bench_many()
+    bench_columns()
+    bench_view()
@@ -4,9 +4,241 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Sequence
+from collections import deque
+from concurrent import futures
 import traceback
 import inspect
+import asyncio
+import re
+import random
+import hashlib
+import threading
+import time
+import os
+
+
+_stringify_limits = {"max_frames": None, "max_bytes": None, "collapse_recursion": False}
+
+
+def set_stringify_limits(max_frames=None, max_bytes=None, collapse_recursion=False):
+    _stringify_limits["max_frames"] = max_frames if max_frames else None
+    _stringify_limits["max_bytes"] = max_bytes if max_bytes else None
+    _stringify_limits["collapse_recursion"] = bool(collapse_recursion)
+
+
+def _collapse_frames(frames, max_period=8):
+    # Collapses the blocks of frames that repeat themselves back to back (e.g.,
+    # mutual recursion). Python already collapses single repeated frames.
+    keys = [(f.filename, f.lineno, f.name) for f in frames]
+    parts = []
+    i, n = 0, len(keys)
+    while i < n:
+        best_period, best_repeats = 1, 0
+        for period in range(2, max_period + 1):
+            block = keys[i : i + period]
+            if len(block) < period:
+                break
+            repeats = 0
+            j = i + period
+            while keys[j : j + period] == block:
+                repeats += 1
+                j += period
+            if repeats and repeats * period > best_repeats * best_period:
+                best_period, best_repeats = period, repeats
+        if best_repeats:
+            parts.append((frames[i : i + best_period], best_period, best_repeats))
+            i += best_period * (best_repeats + 1)
+        else:
+            parts.append((frames[i : i + 1], 1, 0))
+            i += 1
+    return parts
+
+
+def _format_frames(frames, max_frames=None, collapse_recursion=False):
+    omitted = 0
+    if max_frames and len(frames) > max_frames:
+        omitted = len(frames) - max_frames
+        frames = frames[omitted:]
+
+    lines = [f"  [... {omitted} frames omitted]\n"] if omitted else []
+    if collapse_recursion:
+        for block, period, repeats in _collapse_frames(frames):
+            lines.extend(traceback.StackSummary.from_list(block).format())
+            if repeats:
+                lines.append(
+                    f"  [Previous {period} frames repeated {repeats} more times]\n"
+                )
+    else:
+        lines.extend(traceback.StackSummary.from_list(frames).format())
+    return "".join(lines)
+
+
+_detach_options = {"enabled": False, "source_lines": True}
+
+
+def set_detach_frames(enabled=True, source_lines=True):
+    _detach_options["enabled"] = bool(enabled)
+    _detach_options["source_lines"] = bool(source_lines)
+
+
+def _detach_error(error, source_lines):
+    # Replaces the tracebacks of the error (and of its chained errors) with
+    # compact frame summaries, then releases the frames and their locals.
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        tb = getattr(error, "__traceback__", None)
+        if tb is not None:
+            try:
+                if source_lines:
+                    frames = traceback.extract_tb(tb)
+                else:
+                    frames = traceback.StackSummary.from_list(
+                        [
+                            traceback.FrameSummary(
+                                f.filename, f.lineno, f.name, lookup_line=False, line=""
+                            )
+                            for f in traceback.StackSummary.extract(
+                                traceback.walk_tb(tb), lookup_lines=False
+                            )
+                        ]
+                    )
+                error._puffy_frames = frames
+                traceback.clear_frames(tb)
+                error.__traceback__ = None
+            except:
+                pass
+        error = error.__cause__ if error.__cause__ is not None else error.__context__
+
+
+def _error_frames(error):
+    frames = getattr(error, "_puffy_frames", None)
+    if frames is not None:
+        return frames
+    tb = getattr(error, "__traceback__", None)
+    return traceback.extract_tb(tb) if tb else None
+
+
+def _format_error_trace(error, max_frames=None, collapse_recursion=False):
+    frames = _error_frames(error)
+    return _format_frames(frames, max_frames, collapse_recursion) if frames else ""
+
+
+def _frame_to_dict(frame):
+    item = {"file": frame.filename, "line": frame.lineno, "function": frame.name}
+    # The raw (i.e., not stripped) line is needed to position the error carets.
+    source = getattr(frame, "_line", None)
+    source = source if isinstance(source, str) else frame.line
+    if source and source.strip():
+        item["source"] = source
+    for key, attr in [("end_line", "end_lineno"), ("col", "colno")]:
+        value = getattr(frame, attr, None)
+        if value is not None:
+            item[key] = value
+    end_col = getattr(frame, "end_colno", None)
+    if end_col is not None:
+        item["end_col"] = end_col
+    return item
+
+
+def _frame_from_dict(item):
+    options = {}
+    for key, attr in [
+        ("end_line", "end_lineno"),
+        ("col", "colno"),
+        ("end_col", "end_colno"),
+    ]:
+        if key in item:
+            options[attr] = item[key]
+    try:
+        return traceback.FrameSummary(
+            item.get("file"),
+            item.get("line"),
+            item.get("function"),
+            lookup_line=False,
+            line=item.get("source", ""),
+            **options,
+        )
+    except TypeError:
+        # Python versions without column positions.
+        return traceback.FrameSummary(
+            item.get("file"),
+            item.get("line"),
+            item.get("function"),
+            lookup_line=False,
+            line=item.get("source", ""),
+        )
+
+
+def _error_type(error):
+    cls = type(error)
+    if cls.__module__ == "builtins":
+        return cls.__qualname__
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _error_to_dict(error):
+    if isinstance(error, _SerializedError):
+        return {
+            "type": error.type,
+            "message": str(error),
+            "frames": [_frame_to_dict(f) for f in error._puffy_frames],
+        }
+    frames = _error_frames(error)
+    return {
+        "type": _error_type(error),
+        "message": str(error),
+        "frames": [_frame_to_dict(f) for f in frames] if frames else [],
+    }
+
+
+_VARIABLE_PARTS = re.compile(
+    "|".join(
+        [
+            r"'[^']*'",
+            r'"[^"]*"',
+            r"\b[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\b",
+            r"\b0x[0-9a-fA-F]+\b",
+            r"\b[0-9a-fA-F]{16,}\b",
+            r"\d+(?:\.\d+)?",
+        ]
+    )
+)
+
+
+def _normalize_message(message):
+    # Replaces the parts of a message that change between occurrences of the
+    # same error (e.g., quoted values, ids, addresses or numbers).
+    return _VARIABLE_PARTS.sub("*", message)
+
+
+def _error_signature(error):
+    error_type = error.type if isinstance(error, _SerializedError) else None
+    parts = [error_type or _error_type(error), _normalize_message(str(error))]
+    frames = _error_frames(error)
+    if frames:
+        parts.extend(f"{f.filename}:{f.name}:{f.lineno}" for f in frames)
+    return "\n".join(parts)
+
+
+class _SerializedError(Exception):
+    # Error rebuilt from its structured form (e.g., in another process).
+    def __init__(self, message, type=None, frames=None):
+        super().__init__(message)
+        self.type = type
+        self._puffy_frames = traceback.StackSummary.from_list(
+            [_frame_from_dict(x) for x in frames or []]
+        )
+
+
+def _truncate(text, max_bytes):
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    marker = "\n[... truncated]"
+    size = max(max_bytes - len(marker.encode("utf-8")), 0)
+    return data[:size].decode("utf-8", "ignore") + marker
 
 
 class _WrappedFunction:
@@ -17,41 +249,198 @@ class _WrappedFunction:
         self.description = f'File "{file}", line {line}, in {name}'
 
 
+def _locate(fn):
+    # Only called when the wrapped function fails. The location is read from the
+    # function's code object, which is much cheaper than 'inspect.getsourcelines'.
+    try:
+        name = fn.__name__
+        try:
+            code = inspect.unwrap(fn).__code__
+            return _WrappedFunction(name, code.co_filename, code.co_firstlineno)
+        except:
+            pass
+        file = inspect.getfile(fn)
+        try:
+            lines = inspect.getsourcelines(fn)
+            line = lines[1] if lines and len(lines) >= 2 else 0
+        except:
+            line = ""
+        return _WrappedFunction(name, file, line)
+    except:
+        return _WrappedFunction("", "", "")
+
+
+class _ErrorNode:
+    __slots__ = ("error", "next", "size", "detached")
+
+    def __init__(self, error, next=None):
+        self.error = error
+        self.next = next
+        self.size = next.size + 1 if next is not None else 1
+        self.detached = False
+
+
+class _ErrorStack(Sequence):
+    # Read-only, list-like view over a persistent linked list of errors. A new
+    # StackedException shares the stack of the StackedException it wraps
+    # instead of copying it, so wrapping costs O(1) whatever the depth.
+    __slots__ = ("_head", "_items")
+
+    def __init__(self, head=None):
+        self._head = head
+        self._items = None
+
+    def __len__(self):
+        return self._head.size if self._head is not None else 0
+
+    def __iter__(self):
+        node = self._head
+        while node is not None:
+            yield node.error
+            node = node.next
+
+    def __getitem__(self, index):
+        if index == 0 and self._head is not None:
+            return self._head.error
+        if self._items is None:
+            self._items = tuple(self)
+        return self._items[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (_ErrorStack, list, tuple)):
+            return len(self) == len(other) and all(
+                a is b or a == b for a, b in zip(self, other)
+            )
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class StackedException(Exception):
     def __init__(self, *errors):
-        def __flatten(*errors):
-            stack = []
-            head, *tails = errors
-            _errors = errors
-            self.__wrapped_fn = None
-            if head and isinstance(head, _WrappedFunction):
-                self.__wrapped_fn = head
-                _errors = tails
-
-            for error in _errors:
-                if isinstance(error, StackedException):
-                    stack.extend(error.stack)
-                elif isinstance(error, Exception):
-                    stack.append(error)
-                elif (
-                    isinstance(error, str)
-                    or isinstance(error, int)
-                    or isinstance(error, float)
-                ):
-                    stack.append(Exception(error))
-                elif isinstance(error, Iterable):
-                    stack.extend(__flatten(error))
-                else:
-                    stack.append(Exception(error))
-            return stack
+        self.__wrapped_fn = None
+        _errors = list(errors)
+        if _errors and isinstance(_errors[0], _WrappedFunction):
+            self.__wrapped_fn = _errors.pop(0)
 
-        self.stack = [] if len(errors) == 0 else __flatten(*errors)
+        # The stack of a trailing StackedException is shared, not copied.
+        tail = None
+        if _errors and isinstance(_errors[-1], StackedException):
+            tail = _errors.pop().stack._head
 
-        ln = len(self.stack)
-        head = "Unknown error" if ln == 0 else self.stack[0]
+        items = []
+        iterators = [iter(_errors)]
+        while iterators:
+            try:
+                error = next(iterators[-1])
+            except StopIteration:
+                iterators.pop()
+                continue
+            if isinstance(error, StackedException):
+                items.extend(error.stack)
+            elif isinstance(error, Exception):
+                items.append(error)
+            elif (
+                isinstance(error, str)
+                or isinstance(error, int)
+                or isinstance(error, float)
+            ):
+                items.append(Exception(error))
+            elif isinstance(error, Iterable):
+                iterators.append(iter(error))
+            else:
+                items.append(Exception(error))
+
+        for error in reversed(items):
+            tail = _ErrorNode(error, tail)
+        self.stack = _ErrorStack(tail)
+
+        head = "Unknown error" if tail is None else tail.error
         super().__init__(head)
 
-    def stringify(self):
+    def to_dict(self):
+        # Structured, JSON-serializable and picklable form of the error stack.
+        cache = self.__dict__.get("_serialized")
+        if cache is None:
+            fn = self.__wrapped_fn
+            cache = self._serialized = {
+                "function": {"name": fn.name, "file": fn.file, "line": fn.line}
+                if fn
+                else None,
+                "errors": [_error_to_dict(x) for x in self.stack],
+            }
+        return cache
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data if data else {}
+        fn = data.get("function")
+        errors = [
+            _SerializedError(x.get("message"), x.get("type"), x.get("frames"))
+            for x in data.get("errors") or []
+        ]
+        if fn:
+            return cls(
+                _WrappedFunction(fn.get("name"), fn.get("file"), fn.get("line")),
+                errors,
+            )
+        return cls(errors)
+
+    def __reduce__(self):
+        return (_stacked_exception_from_dict, (self.to_dict(), type(self)))
+
+    def __copy__(self):
+        # The stack is immutable, so a shallow copy shares it and keeps the
+        # original errors ('deepcopy' uses the structured form, like pickle).
+        err = type(self).__new__(type(self))
+        err.__dict__.update(self.__dict__)
+        err.args = self.args
+        return err
+
+    def fingerprint(self):
+        # Stable id of the error stack, made of the error types, their normalized
+        # messages and their frame locations. Occurrences of the same failure
+        # share the same fingerprint.
+        cache = self.__dict__.get("_fingerprint")
+        if cache is None:
+            fn = self.__wrapped_fn
+            parts = [f"{fn.file}:{fn.name}:{fn.line}" if fn else ""]
+            parts.extend(_error_signature(x) for x in self.stack)
+            digest = hashlib.sha1("\n\n".join(parts).encode("utf-8"))
+            cache = self._fingerprint = digest.hexdigest()[:16]
+        return cache
+
+    def detach(self, source_lines=None):
+        if source_lines is None:
+            source_lines = _detach_options["source_lines"]
+        # Shared tails are detached once, so wrapping a detached StackedException
+        # only detaches the new errors.
+        node = self.stack._head
+        while node is not None and not node.detached:
+            _detach_error(node.error, source_lines)
+            node.detached = True
+            node = node.next
+        return self
+
+    def stringify(self, max_frames=None, max_bytes=None, collapse_recursion=None):
+        # The text is memoized because the same error is often logged many times.
+        key = (
+            max_frames or _stringify_limits["max_frames"],
+            max_bytes or _stringify_limits["max_bytes"],
+            _stringify_limits["collapse_recursion"]
+            if collapse_recursion is None
+            else collapse_recursion,
+        )
+        cache = self.__dict__.get("_stringified")
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        text = self.__stringify(*key)
+        self._stringified = (key, text)
+        return text
+
+    def __stringify(self, max_frames, max_bytes, collapse_recursion):
         if len(self.stack):
             errors = []
             for error in self.stack:
@@ -60,23 +449,216 @@ class StackedException(Exception):
                 error_meta = (
                     f"\n  {self.__wrapped_fn.description}" if self.__wrapped_fn else ""
                 )
-                if hasattr(error, "__traceback__") and error.__traceback__:
-                    error_trace = "".join(traceback.format_tb(error.__traceback__))
-                    error_trace = "\n" + error_trace if error_trace else ""
+                error_trace = _format_error_trace(error, max_frames, collapse_recursion)
+                error_trace = "\n" + error_trace if error_trace else ""
 
                 errors.append(
                     f"error: {error_text}{error_trace if error_trace else error_meta}"
                 )
-            return "\n".join(errors)
+            text = "\n".join(errors)
+            return _truncate(text, max_bytes) if max_bytes else text
         else:
             return ""
 
 
-def catch_errors(arg):
-    if not arg:
+def _stacked_exception_from_dict(data, cls=StackedException):
+    return cls.from_dict(data)
+
+
+class RetryBudget:
+    # Token bucket shared by many retry policies. Each retry takes a token, so
+    # retries cannot amplify the load on a dependency that is already down.
+    def __init__(self, rate=10, burst=None):
+        if rate <= 0:
+            raise Exception("'rate' must be strictly positive.")
+        self.rate = rate
+        self.burst = burst if burst else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class RetryPolicy:
+    def __init__(
+        self, max_attempts=3, base_delay=0.1, max_delay=10, retry_on=None, budget=None
+    ):
+        if not isinstance(max_attempts, int) or max_attempts < 1:
+            raise Exception("'max_attempts' must be a strictly positive integer.")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.budget = budget
+
+    def delay(self, attempt):
+        # Exponential backoff with full jitter.
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+    def should_retry(self, error, attempt):
+        if attempt >= self.max_attempts or not isinstance(error, Exception):
+            return False
+        retry_on = self.retry_on
+        if retry_on is not None:
+            if isinstance(retry_on, type) or isinstance(retry_on, tuple):
+                if not isinstance(error, retry_on):
+                    return False
+            elif not retry_on(error):
+                return False
+        return self.budget is None or self.budget.acquire()
+
+
+def _should_detach(detach_frames):
+    return detach_frames if detach_frames is not None else _detach_options["enabled"]
+
+
+def _stack_errors(location, wrapping_error, errors, detach_frames):
+    err = (
+        StackedException(location, wrapping_error, *errors)
+        if wrapping_error
+        else StackedException(location, *errors)
+    )
+    if _should_detach(detach_frames):
+        err.detach()
+    return err
+
+
+ON_ERROR_POLICIES = ["stop", "skip", "collect"]
+
+
+def _safe_iterate(gen, fail):
+    # A Python generator cannot resume after it raised, so the first error
+    # always ends the stream.
+    try:
+        while True:
+            try:
+                value = next(gen)
+            except StopIteration:
+                return
+            except BaseException as error:
+                yield [fail([error]), None]
+                return
+            yield [None, value]
+    finally:
+        gen.close()
+
+
+async def _async_safe_iterate(gen, fail):
+    try:
+        while True:
+            try:
+                value = await gen.__anext__()
+            except StopAsyncIteration:
+                return
+            except BaseException as error:
+                yield [fail([error]), None]
+                return
+            yield [None, value]
+    finally:
+        await gen.aclose()
+
+
+def _safe_map(fn, items, on_error, fail):
+    errors = []
+    iterator = iter(items)
+    while True:
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        except BaseException as error:
+            # The input stream itself failed. It cannot be resumed.
+            errors.append(error)
+            break
+        try:
+            value = fn(item)
+        except BaseException as error:
+            if on_error == "collect":
+                errors.append(error)
+                continue
+            yield [fail([error]), item]
+            if on_error == "stop":
+                return
+            continue
+        yield [None, value]
+    if errors:
+        yield [fail(errors), None]
+
+
+async def _async_safe_map(fn, items, on_error, fail):
+    errors = []
+    is_async = hasattr(items, "__aiter__")
+    iterator = items.__aiter__() if is_async else iter(items)
+    while True:
+        try:
+            item = await iterator.__anext__() if is_async else next(iterator)
+        except (StopIteration, StopAsyncIteration):
+            break
+        except BaseException as error:
+            errors.append(error)
+            break
+        try:
+            value = await fn(item)
+        except BaseException as error:
+            if on_error == "collect":
+                errors.append(error)
+                continue
+            yield [fail([error]), item]
+            if on_error == "stop":
+                return
+            continue
+        yield [None, value]
+    if errors:
+        yield [fail(errors), None]
+
+
+def _check_stream_options(on_error, item_fn, retry):
+    if on_error is not None and on_error not in ON_ERROR_POLICIES:
+        raise Exception(
+            f"Invalid 'on_error' policy '{on_error}'. Supported values: {', '.join(ON_ERROR_POLICIES)}."
+        )
+    if item_fn is not None and not callable(item_fn):
+        raise Exception(
+            f"Wrong argument exception. 'item_fn' must be a function. Found {type(item_fn).__name__} instead."
+        )
+    if retry is not None and (on_error is not None or item_fn is not None):
+        raise Exception("'retry' is not supported with 'on_error' or 'item_fn'.")
+
+
+def _check_generator_policy(on_error):
+    if on_error != "stop":
+        raise Exception(
+            f"The '{on_error}' policy is not supported with generator functions because a Python generator cannot resume after it raised an exception. Use 'item_fn' instead."
+        )
+
+
+def catch_errors(arg=None, detach_frames=None, retry=None, on_error=None, item_fn=None):
+    if (
+        not arg
+        and detach_frames is None
+        and retry is None
+        and on_error is None
+        and item_fn is None
+    ):
         raise Exception("Missing required argument.")
+    _check_stream_options(on_error, item_fn, retry)
 
-    isAsyncFunction = inspect.iscoroutinefunction(arg)
+    isAsyncFunction = inspect.iscoroutinefunction(arg) or inspect.iscoroutinefunction(
+        item_fn
+    )
     isSyncFunction = callable(arg)
     if isAsyncFunction:
         raise Exception(
@@ -86,49 +668,92 @@ def catch_errors(arg):
     fn = None
     wrappingError = None
 
-    if isSyncFunction:
+    if isSyncFunction and item_fn is None:
         fn = arg
     elif isinstance(arg, str):
         wrappingError = Exception(arg)
-    else:
+    elif arg:
         raise Exception(
             f'Wrong argument exception. "catch_errors"\'s argument must be a function or a string. Found {type(arg).__name__} instead.'
         )
 
     def safe_fn_exec(ffn):
+        location = None
+
+        def fail(errors):
+            nonlocal location
+            if location is None:
+                location = _locate(ffn)
+            return _stack_errors(location, wrappingError, errors, detach_frames)
+
+        if item_fn is not None:
+
+            def safe_map(items):
+                yield from _safe_map(ffn, items, on_error or "stop", fail)
+
+            return safe_map
+
+        if on_error is not None:
+            if not inspect.isgeneratorfunction(ffn):
+                raise Exception(
+                    "'on_error' is only supported with generator functions or with 'item_fn'."
+                )
+            _check_generator_policy(on_error)
+
+            def safe_iterate(*args, **named_args):
+                try:
+                    gen = ffn(*args, **named_args)
+                except BaseException as error:
+                    yield [fail([error]), None]
+                    return
+                yield from _safe_iterate(gen, fail)
+
+            return safe_iterate
+
         def safe_exec(*args, **named_args):
-            fn_name = fn_file = fn_line = None
             try:
-                try:
-                    fn_name = ffn.__name__
-                    fn_file = inspect.getfile(ffn)
-                    try:
-                        lines = inspect.getsourcelines(ffn)
-                        fn_line = lines[1] if lines and len(lines) >= 2 else 0
-                    except:
-                        fn_line = ""
-                except:
-                    fn_name = fn_file = fn_line = ""
                 data = ffn(*args, **named_args)
                 return [None, data]
             except BaseException as error:
-                name = _WrappedFunction(fn_name, fn_file, fn_line)
-                return [
-                    StackedException(name, wrappingError, error)
-                    if wrappingError
-                    else StackedException(name, error),
-                    None,
-                ]
+                errors = [error]
+            if retry is not None:
+                attempt = 1
+                while retry.should_retry(errors[-1], attempt):
+                    time.sleep(retry.delay(attempt))
+                    attempt += 1
+                    try:
+                        data = ffn(*args, **named_args)
+                        return [None, data]
+                    except BaseException as error:
+                        errors.append(error)
+            return [fail(errors), None]
 
         return safe_exec
 
+    if item_fn is not None:
+        return safe_fn_exec(item_fn)
     return safe_fn_exec(fn) if fn else safe_fn_exec
 
 
-def async_catch_errors(arg):
-    if not arg:
+def async_catch_errors(
+    arg=None, detach_frames=None, retry=None, on_error=None, item_fn=None
+):
+    if (
+        not arg
+        and detach_frames is None
+        and retry is None
+        and on_error is None
+        and item_fn is None
+    ):
         raise Exception("Missing required argument.")
-    isAsyncFunction = inspect.iscoroutinefunction(arg)
+    _check_stream_options(on_error, item_fn, retry)
+    if item_fn is not None and not inspect.iscoroutinefunction(item_fn):
+        raise Exception(
+            "Invalid argument exception. 'async_catch_errors' does not accept synchronous functions. Use 'catch_errors' instead."
+        )
+    isAsyncFunction = inspect.iscoroutinefunction(arg) or (
+        on_error is not None and inspect.isasyncgenfunction(arg)
+    )
     isSyncFunction = callable(arg) and not isAsyncFunction
     if isSyncFunction:
         raise Exception(
@@ -142,36 +767,471 @@ def async_catch_errors(arg):
         afn = arg
     elif isinstance(arg, str):
         wrappingError = Exception(arg)
-    else:
+    elif arg:
         raise Exception(
             f'Wrong argument exception. "catch_errors"\'s argument must be a function or a string. Found {type(arg).__name__} instead.'
         )
 
     def safe_fn_exec(ffn):
+        location = None
+
+        def fail(errors):
+            nonlocal location
+            if location is None:
+                location = _locate(ffn)
+            return _stack_errors(location, wrappingError, errors, detach_frames)
+
+        if item_fn is not None:
+
+            async def async_safe_map(items):
+                async for pair in _async_safe_map(ffn, items, on_error or "stop", fail):
+                    yield pair
+
+            return async_safe_map
+
+        if on_error is not None:
+            if not inspect.isasyncgenfunction(ffn):
+                raise Exception(
+                    "'on_error' is only supported with async generator functions or with 'item_fn'."
+                )
+            _check_generator_policy(on_error)
+
+            async def async_safe_iterate(*args, **named_args):
+                try:
+                    gen = ffn(*args, **named_args)
+                except BaseException as error:
+                    yield [fail([error]), None]
+                    return
+                async for pair in _async_safe_iterate(gen, fail):
+                    yield pair
+
+            return async_safe_iterate
+
         async def async_safe_exec(*args, **named_args):
-            fn_name = fn_file = fn_line = None
             try:
-                try:
-                    fn_name = ffn.__name__
-                    fn_file = inspect.getfile(ffn)
-                    try:
-                        lines = inspect.getsourcelines(ffn)
-                        fn_line = lines[1] if lines and len(lines) >= 2 else 0
-                    except:
-                        fn_line = ""
-                except:
-                    fn_name = fn_file = fn_line = ""
                 data = await ffn(*args, **named_args)
                 return [None, data]
             except BaseException as error:
-                name = _WrappedFunction(fn_name, fn_file, fn_line)
+                errors = [error]
+            if retry is not None:
+                attempt = 1
+                while retry.should_retry(errors[-1], attempt):
+                    await asyncio.sleep(retry.delay(attempt))
+                    attempt += 1
+                    try:
+                        data = await ffn(*args, **named_args)
+                        return [None, data]
+                    except BaseException as error:
+                        errors.append(error)
+            return [fail(errors), None]
+
+        return async_safe_exec
+
+    if item_fn is not None:
+        return safe_fn_exec(item_fn)
+    return safe_fn_exec(afn) if afn else safe_fn_exec
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Fails the calls fast while the dependency is unhealthy. The failure rate
+    # is measured over a sliding 'window' (seconds) split in 'buckets'. Once it
+    # reaches 'failure_rate' (with at least 'min_calls' calls), the circuit
+    # opens for 'reset_timeout' seconds, then lets 'half_open_calls' probes
+    # through. The probes close the circuit when they all succeed.
+    def __init__(
+        self,
+        name=None,
+        failure_rate=0.5,
+        min_calls=10,
+        window=60,
+        buckets=10,
+        reset_timeout=30,
+        half_open_calls=1,
+        failure_on=None,
+    ):
+        if not 0 < failure_rate <= 1:
+            raise Exception("'failure_rate' must be between 0 (excluded) and 1.")
+        if window <= 0 or not isinstance(buckets, int) or buckets < 1:
+            raise Exception(
+                "'window' and 'buckets' must be strictly positive, and 'buckets' must be an integer."
+            )
+        self.name = name or "circuit_breaker"
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = max(1, half_open_calls)
+        self.failure_on = failure_on
+        self._width = window / buckets
+        self._epochs = [-1] * buckets
+        self._calls = [0] * buckets
+        self._failures = [0] * buckets
+        self._opened_at = 0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+        self.state = "closed"
+
+    def _is_failure(self, err):
+        failure_on = self.failure_on
+        if failure_on is None:
+            return True
+        if isinstance(failure_on, type) or isinstance(failure_on, tuple):
+            return any(isinstance(error, failure_on) for error in err.stack)
+        return failure_on(err)
+
+    def _reset_window(self):
+        size = len(self._epochs)
+        self._epochs = [-1] * size
+        self._calls = [0] * size
+        self._failures = [0] * size
+
+    def _acquire(self):
+        # Lock-free on the hot path, i.e., while the circuit is closed.
+        if self.state == "closed":
+            return True, None
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True, None
+            if state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False, None
+                self.state = "half_open"
+                self._probes = 0
+                self._probe_successes = 0
+                transition = ("open", "half_open")
+            else:
+                transition = None
+            if self._probes >= self.half_open_calls:
+                return False, transition
+            self._probes += 1
+            return True, transition
+
+    def _record(self, failed):
+        with self._lock:
+            state = self.state
+            if state == "half_open":
+                if failed:
+                    self.state = "open"
+                    self._opened_at = time.monotonic()
+                    return (state, "open")
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self.state = "closed"
+                    self._reset_window()
+                    return (state, "closed")
+                return None
+            if state == "open":
+                return None
+
+            epoch = int(time.monotonic() / self._width)
+            index = epoch % len(self._epochs)
+            if self._epochs[index] != epoch:
+                self._epochs[index] = epoch
+                self._calls[index] = 0
+                self._failures[index] = 0
+            self._calls[index] += 1
+            if not failed:
+                return None
+            self._failures[index] += 1
+
+            oldest = epoch - len(self._epochs)
+            calls = 0
+            failures = 0
+            for i, e in enumerate(self._epochs):
+                if e > oldest:
+                    calls += self._calls[i]
+                    failures += self._failures[i]
+            if calls >= self.min_calls and failures >= self.failure_rate * calls:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                return (state, "open")
+            return None
+
+    def _release(self):
+        # Frees the probe slot of a half-open call that did not complete.
+        with self._lock:
+            if self.state == "half_open" and self._probes > 0:
+                self._probes -= 1
+
+    def _log(self, transition):
+        if transition is None:
+            return
+        from ..log import log  # Lazy import. 'puffy.log' depends on this module.
+
+        previous, state = transition
+        log(
+            level="WARN" if state == "open" else "INFO",
+            message=f"Circuit breaker '{self.name}' changed from {previous} to {state}.",
+            code="circuit_breaker",
+            data={"name": self.name, "previous_state": previous, "state": state},
+        )
+
+    def _rejected(self, location, wrappingError):
+        error = CircuitOpenError(f"Circuit breaker '{self.name}' is {self.state}.")
+        if wrappingError:
+            return [StackedException(location, wrappingError, error), None]
+        return [StackedException(location, error), None]
+
+    def __call__(self, arg=None, detach_frames=None, retry=None):
+        if not arg and detach_frames is None and retry is None:
+            raise Exception("Missing required argument.")
+
+        fn = None
+        wrappingError = None
+        if callable(arg):
+            fn = arg
+        elif isinstance(arg, str):
+            wrappingError = Exception(arg)
+        elif arg:
+            raise Exception(
+                f'Wrong argument exception. "CircuitBreaker"\'s argument must be a function or a string. Found {type(arg).__name__} instead.'
+            )
+
+        def wrap(ffn):
+            if inspect.isgeneratorfunction(ffn) or inspect.isasyncgenfunction(ffn):
+                raise Exception(
+                    "Invalid argument exception. 'CircuitBreaker' does not accept generator functions."
+                )
+            location = None
+            options = dict(detach_frames=detach_frames, retry=retry)
+
+            if inspect.iscoroutinefunction(ffn):
+                safe_fn = async_catch_errors(arg or None, **options)
+                safe_fn = safe_fn if fn else safe_fn(ffn)
+
+                async def async_protected_exec(*args, **named_args):
+                    nonlocal location
+                    allowed, transition = self._acquire()
+                    self._log(transition)
+                    if not allowed:
+                        if location is None:
+                            location = _locate(ffn)
+                        return self._rejected(location, wrappingError)
+                    try:
+                        err, data = await safe_fn(*args, **named_args)
+                        failed = err is not None and self._is_failure(err)
+                    except BaseException:
+                        self._release()
+                        raise
+                    self._log(self._record(failed))
+                    return [err, data]
+
+                return async_protected_exec
+
+            safe_fn = catch_errors(arg or None, **options)
+            safe_fn = safe_fn if fn else safe_fn(ffn)
+
+            def protected_exec(*args, **named_args):
+                nonlocal location
+                allowed, transition = self._acquire()
+                self._log(transition)
+                if not allowed:
+                    if location is None:
+                        location = _locate(ffn)
+                    return self._rejected(location, wrappingError)
+                try:
+                    err, data = safe_fn(*args, **named_args)
+                    failed = err is not None and self._is_failure(err)
+                except BaseException:
+                    self._release()
+                    raise
+                self._log(self._record(failed))
+                return [err, data]
+
+            return protected_exec
+
+        return wrap(fn) if fn else wrap
+
+
+def _safe_call(safe_fn, item):
+    # 'safe_fn' is None when the items are the functions to call.
+    try:
+        if safe_fn is None:
+            if not callable(item):
                 return [
-                    StackedException(name, wrappingError, error)
-                    if wrappingError
-                    else StackedException(name, error),
+                    StackedException(
+                        f"Invalid item. Expected a function when 'fn' is not set. Found {type(item).__name__} instead."
+                    ),
                     None,
                 ]
+            return catch_errors(item)()
+        elif isinstance(item, tuple):
+            return safe_fn(*item)
+        else:
+            return safe_fn(item)
+    except BaseException as error:
+        return [StackedException(error), None]
 
-        return async_safe_exec
 
-    return safe_fn_exec(afn) if afn else safe_fn_exec
+def _exec_chunk(fn, chunk):
+    safe_fn = catch_errors(fn) if fn is not None else None
+    return [_safe_call(safe_fn, item) for item in chunk]
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def batch_exec(
+    items,
+    fn=None,
+    executor="thread",
+    max_workers=None,
+    chunk_size=1,
+    ordered=True,
+    max_pending=None,
+):
+    # Runs 'fn(*item)' (or 'item()' when 'fn' is None) for each item on a thread
+    # or process pool and yields the '(err, resp)' pairs. 'items' is consumed
+    # lazily: at most 'max_pending' chunks are submitted at once.
+    if executor not in ["thread", "process"] and not isinstance(
+        executor, futures.Executor
+    ):
+        raise Exception(
+            f"Invalid executor '{executor}'. Supported values: thread, process or a concurrent.futures.Executor instance."
+        )
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise Exception("'chunk_size' must be a strictly positive integer.")
+
+    owned = not isinstance(executor, futures.Executor)
+    if owned:
+        pool_class = (
+            futures.ThreadPoolExecutor
+            if executor == "thread"
+            else futures.ProcessPoolExecutor
+        )
+        pool = pool_class(max_workers=max_workers)
+    else:
+        pool = executor
+    workers = max_workers or getattr(pool, "_max_workers", None) or os.cpu_count() or 1
+    max_pending = max_pending if max_pending else workers * 2
+
+    chunks = _chunks(items, chunk_size)
+    pending = deque()
+
+    def submit():
+        for chunk in chunks:
+            pending.append((pool.submit(_exec_chunk, fn, chunk), len(chunk)))
+            if len(pending) >= max_pending:
+                break
+
+    def results(future, size):
+        try:
+            return future.result()
+        except BaseException as error:
+            # The chunk could not run at all (e.g., it could not be pickled).
+            err = StackedException(error)
+            return [[err, None] for _ in range(size)]
+
+    try:
+        submit()
+        while pending:
+            if ordered:
+                future, size = pending.popleft()
+                done = [(future, size)]
+            else:
+                futures.wait(
+                    [f for f, _ in pending], return_when=futures.FIRST_COMPLETED
+                )
+                done = [x for x in pending if x[0].done()]
+                for x in done:
+                    pending.remove(x)
+            for future, size in done:
+                for err, resp in results(future, size):
+                    yield err, resp
+            submit()
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        if owned:
+            pool.shutdown(wait=True)
+
+
+async def _async_safe_call(factory, timeout):
+    try:
+        if not timeout:
+            return [None, await factory()]
+        task = asyncio.ensure_future(factory())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if done:
+            return [None, task.result()]
+        # Only an expired 'timeout' is reported as such. A 'TimeoutError' raised
+        # by the coroutine itself is reported as is.
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        errors = [f"Timed out after {timeout} seconds.", asyncio.TimeoutError()]
+    except asyncio.CancelledError:
+        raise
+    except BaseException as error:
+        errors = [error]
+    return [_stack_errors(_locate(factory), None, errors, None), None]
+
+
+async def async_batch_exec(factories, limit=10, fail_fast=False, timeout=None):
+    # Runs the coroutines created by 'factories' (an iterable or async iterable
+    # of functions without arguments returning an awaitable) with at most
+    # 'limit' of them at once, and yields the '(err, resp)' pairs as they
+    # complete. With 'fail_fast', the first error cancels the running tasks.
+    if not isinstance(limit, int) or limit < 1:
+        raise Exception("'limit' must be a strictly positive integer.")
+
+    if hasattr(factories, "__aiter__"):
+        iterator = factories.__aiter__()
+
+        async def next_factory():
+            try:
+                return await iterator.__anext__()
+            except StopAsyncIteration:
+                return None
+
+    else:
+        iterator = iter(factories)
+
+        async def next_factory():
+            return next(iterator, None)
+
+    running = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(running) < limit:
+                factory = await next_factory()
+                if factory is None:
+                    exhausted = True
+                else:
+                    running.add(
+                        asyncio.ensure_future(_async_safe_call(factory, timeout))
+                    )
+            if not running:
+                return
+
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                err, resp = task.result()
+                yield err, resp
+                if err and fail_fast:
+                    return
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
@@ -5,26 +5,217 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-import copy
+import sys
 import json
+import asyncio
+import atexit
+import inspect
+import bisect
+import random
 import secrets
-import traceback
-from ..error import StackedException
+import functools
+import threading
+import contextvars
+from time import monotonic, perf_counter_ns, time as _now
+from collections import deque
+from ..error import StackedException, _format_error_trace, _error_to_dict
+from ..object import JSONView, JSONListView
+from .sink import Sink, StdoutSink, FileSink, UnixSocketSink  # noqa: F401
 
 LEVELS = ["INFO", "WARN", "ERROR", "CRITICAL"]
+OVERFLOW_POLICIES = ["block", "drop_newest", "drop_oldest"]
+ERRORS_FORMATS = ["text", "structured"]
 
+_LEVEL_NAMES = {
+    **{x: x for x in LEVELS},
+    **{x.lower(): x for x in LEVELS},
+    "WARNING": "WARN",
+    "warning": "WARN",
+}
+_LEVEL_RANKS = {x: i for i, x in enumerate(LEVELS)}
+_INFO_RANK = _LEVEL_RANKS["INFO"]
+_ERROR_RANK = _LEVEL_RANKS["ERROR"]
 
-def _getGlobalMeta():
-    log_meta = os.getenv("LOG_META")
+
+def _normalize_level(level):
+    try:
+        name = _LEVEL_NAMES.get(level)
+        if name is not None:
+            return name
+    except:
+        pass
+    level = str.upper(f"{level}").strip()
+    if level == "WARNING":
+        level = "WARN"
+    return level if level in _LEVEL_RANKS else "INFO"
+
+
+def _parse_level(level):
+    if level is None or not f"{level}".strip():
+        return 0
+    name = str.upper(f"{level}").strip()
+    name = "WARN" if name == "WARNING" else name
+    if name not in _LEVEL_RANKS:
+        raise Exception(
+            f"Invalid log level '{level}'. Supported values: {', '.join(LEVELS)}."
+        )
+    return _LEVEL_RANKS[name]
+
+
+try:
+    _min_rank = _parse_level(os.getenv("LOG_LEVEL"))
+except:
+    _min_rank = 0
+
+
+def set_level(level=None):
+    global _min_rank
+    if level is None:
+        try:
+            _min_rank = _parse_level(os.getenv("LOG_LEVEL"))
+        except:
+            _min_rank = 0
+    else:
+        _min_rank = _parse_level(level)
+
+
+def get_level():
+    return LEVELS[_min_rank]
+
+
+def is_enabled(level="INFO"):
+    try:
+        return _LEVEL_RANKS[_normalize_level(level)] >= _min_rank
+    except:
+        return True
+
+
+def _json_default(obj):
+    # Lazy JSON views are serialized as is, without copying them.
+    if isinstance(obj, JSONView) or isinstance(obj, JSONListView):
+        return obj.unwrap()
+    return str(obj)
+
+
+class _Fields:
+    # Immutable set of fields. A child only stores the keys it changes and points
+    # to its parent, so deriving a new set costs O(changed keys). The merged dict
+    # and its JSON fragment are computed once, on first use, and then shared by
+    # every log record using that set.
+    __slots__ = ("parent", "values", "depth", "_merged", "_fragment", "_own", "_join")
+
+    def __init__(self, values=None, parent=None):
+        self.parent = parent if parent is not None and parent.values else None
+        self.values = values if values else {}
+        self.depth = self.parent.depth + 1 if self.parent is not None else 0
+        self._merged = None if self.parent is not None else self.values
+        self._fragment = None
+        self._own = None
+        self._join = None
+
+    @property
+    def merged(self):
+        if self._merged is None:
+            merged = dict(self.parent.merged)
+            merged.update(self.values)
+            self._merged = merged
+        return self._merged
+
+    @property
+    def fragment(self):
+        if self._fragment is None:
+            if self._own is None:
+                self._own = (
+                    json.dumps(self.values, default=_json_default)[1:-1]
+                    if self.values
+                    else ""
+                )
+            parent = self.parent
+            if parent is None:
+                self._fragment = self._own
+            elif not self._own:
+                self._fragment = parent.fragment
+            elif parent.merged.keys().isdisjoint(self.values):
+                self._fragment = parent.fragment + ", " + self._own
+            else:
+                self._fragment = json.dumps(self.merged, default=_json_default)[1:-1]
+        return self._fragment
+
+    def child(self, values):
+        if not values:
+            return self
+        # Collapses long chains (e.g., 'set_context' called in a loop) so that
+        # they do not grow forever.
+        if self.depth >= 8:
+            merged = dict(self.merged)
+            merged.update(values)
+            return _Fields(merged)
+        return _Fields(values, self)
+
+    def join(self, head):
+        # Returns 'head' followed by this set, reusing this set's fragment. The
+        # last join is cached because 'head' (i.e., LOG_META) rarely changes.
+        if not self.values:
+            return head
+        if not head.values:
+            return self
+        join = self._join
+        if join is None or join[0] is not head:
+            fields = _Fields(self.merged, head)
+            fields._own = self.fragment
+            join = self._join = (head, fields)
+        return join[1]
+
+
+_EMPTY_FIELDS = _Fields()
+_meta_raw = None
+_meta = _EMPTY_FIELDS
+
+
+def _parseGlobalMeta(log_meta):
     if log_meta and (log_meta is not None):
         try:
             meta = json.loads(log_meta)
             if meta and type(meta) == dict:
-                return meta
+                return _Fields(meta)
         except:
             pass
 
-    return {}
+    return _EMPTY_FIELDS
+
+
+def _getGlobalMeta():
+    global _meta_raw, _meta
+    log_meta = os.getenv("LOG_META")
+    if log_meta != _meta_raw:
+        _meta = _parseGlobalMeta(log_meta)
+        _meta_raw = log_meta
+    return _meta
+
+
+def reload_meta():
+    global _meta_raw, _meta
+    _meta_raw = os.getenv("LOG_META")
+    _meta = _parseGlobalMeta(_meta_raw)
+    return dict(_meta.merged)
+
+
+def _dumps(fields, log_data):
+    if not fields.values:
+        return json.dumps(log_data, default=_json_default)
+
+    merged = fields.merged
+    if merged.keys().isdisjoint(log_data):
+        return (
+            "{"
+            + fields.fragment
+            + ", "
+            + json.dumps(log_data, default=_json_default)[1:]
+        )
+    else:
+        merged = dict(merged)
+        merged.update(log_data)
+        return json.dumps(merged, default=_json_default)
 
 
 def _get_id():
@@ -46,9 +237,8 @@ def _stringify_error(error):
             error_text = str(error)
             error_trace = ""
             try:
-                if hasattr(error, "__traceback__") and error.__traceback__:
-                    error_trace = "".join(traceback.format_tb(error.__traceback__))
-                    error_trace = "\n" + error_trace if error_trace else ""
+                error_trace = _format_error_trace(error)
+                error_trace = "\n" + error_trace if error_trace else ""
             except:
                 pass
             return f"{error_text}{error_trace}"
@@ -64,70 +254,863 @@ def _stringify_error(error):
         return ""
 
 
-global_context = {}
+_errors_format = "text"
 
 
-def set_context(**args):
-    global global_context
+def set_errors_format(errors_format="text"):
+    global _errors_format
+    if errors_format not in ERRORS_FORMATS:
+        raise Exception(
+            f"Invalid errors format '{errors_format}'. Supported values: {', '.join(ERRORS_FORMATS)}."
+        )
+    _errors_format = errors_format
+
+
+def _structure_errors(errors):
+    items = errors if isinstance(errors, (list, tuple)) else [errors]
+    structured = []
+    for error in items:
+        if isinstance(error, StackedException):
+            data = error.to_dict()
+            fn = data["function"]
+            for item in data["errors"]:
+                # Same as 'stringify': errors without frames are located with the
+                # function that caught them.
+                if fn and not item["frames"]:
+                    item = dict(item, function=fn)
+                structured.append(item)
+        elif isinstance(error, BaseException):
+            structured.append(_error_to_dict(error))
+        elif error or error == 0:
+            structured.append({"type": None, "message": f"{error}", "frames": []})
+    return structured
+
+
+_sink = None
+
+
+def set_sink(sink=None):
+    global _sink
+    if sink is not None and not isinstance(sink, Sink):
+        raise Exception(
+            f"Wrong argument exception. 'sink' must be a puffy.log.sink.Sink. Found {type(sink).__name__} instead."
+        )
+    previous = _sink
+    _sink = sink
+    if previous is not None and previous is not sink:
+        try:
+            previous.flush()
+        except:
+            pass
+    return previous
+
+
+def _write_lines(lines):
+    sink = _sink
+    if sink is not None:
+        sink.write_lines(lines)
+    else:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+class _AsyncWriter:
+    # Bounded queue drained by a single background thread. Each drained batch
+    # is joined and written with one 'write' call.
+    def __init__(self, write, queue_size, batch_size, overflow):
+        self._write = write
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._overflow = overflow
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(
+            target=self._run, name="puffy-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, line):
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._queue) >= self._queue_size:
+                if self._overflow == "drop_newest":
+                    self.dropped += 1
+                    return True
+                elif self._overflow == "drop_oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self._queue_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+            self._queue.append(line)
+            self._not_empty.notify()
+            return True
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            with self._lock:
+                while not queue and not self._closed:
+                    self._not_empty.wait()
+                if not queue:
+                    self._all_done.notify_all()
+                    return
+                size = min(len(queue), self._batch_size)
+                batch = [queue.popleft() for _ in range(size)]
+                self._in_flight = size
+                self._not_full.notify_all()
+            try:
+                self._write(batch)
+            except:
+                pass
+            with self._lock:
+                self._in_flight = 0
+                if not queue:
+                    self._all_done.notify_all()
+
+    def flush(self, timeout=None):
+        with self._lock:
+            return self._all_done.wait_for(
+                lambda: not self._queue and not self._in_flight, timeout
+            )
+
+    def close(self, timeout=None):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        self._thread.join(timeout)
+
+    def fork(self):
+        # New writer with the same options and an empty queue. The lines queued
+        # before a fork are written by the parent process only.
+        return _AsyncWriter(
+            self._write, self._queue_size, self._batch_size, self._overflow
+        )
+
+
+_writer = None
+
+
+def enable_async(queue_size=10000, batch_size=500, overflow="block"):
+    global _writer
+    if overflow not in OVERFLOW_POLICIES:
+        raise Exception(
+            f"Invalid overflow policy '{overflow}'. Supported values: {', '.join(OVERFLOW_POLICIES)}."
+        )
+    if not isinstance(queue_size, int) or queue_size < 1:
+        raise Exception("'queue_size' must be a strictly positive integer.")
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise Exception("'batch_size' must be a strictly positive integer.")
+
+    disable_async()
+    _writer = _AsyncWriter(_write_lines, queue_size, batch_size, overflow)
+
+
+def disable_async(timeout=None):
+    global _writer
+    writer = _writer
+    _writer = None
+    if writer is not None:
+        writer.close(timeout)
+
+
+def _after_fork_in_child():
+    # The background threads are not copied into a forked child (e.g., the
+    # workers of 'batch_exec(executor="process")'), so its writer is rebuilt.
+    global _writer
+    writer = _writer
+    if writer is not None:
+        _writer = writer.fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def flush(timeout=None):
+    if _aggregator is not None:
+        _aggregator.flush()
+    if _error_aggregator is not None:
+        _error_aggregator.flush()
+    if _rate_limited:
+        _flush_suppressed()
+    writer = _writer
+    done = writer.flush(timeout) if writer is not None else True
+    sink = _sink
+    if sink is not None:
+        try:
+            sink.flush()
+        except:
+            pass
+    return done
+
+
+def get_dropped_count():
+    writer = _writer
+    return writer.dropped if writer is not None else 0
+
+
+def _shutdown():
+    disable_metric_aggregation()
+    disable_error_aggregation()
+    disable_async()
+    flush()
+
+
+atexit.register(_shutdown)
+
+
+def _emit(log_str, print_mock):
+    if print_mock and print_mock is not None:
+        print_mock(log_str)
+    elif _writer is not None and _writer.put(log_str):
+        pass
+    elif _sink is not None:
+        _sink.write_lines([log_str])
+    else:
+        print(log_str)
+
+
+# The process-wide context, seen by every thread and task, and the context of
+# the current 'log_context' scope (None outside of any scope), layered over it.
+_global_context = _EMPTY_FIELDS
+_global_context_lock = threading.Lock()
+_context = contextvars.ContextVar("puffy_log_context", default=None)
+
+
+def _get_context():
+    scoped = _context.get()
+    if scoped is None:
+        return _global_context
+    return scoped.join(_global_context)
+
+
+def set_global_context(**args):
+    global _global_context
     try:
-        for key in args:
-            global_context[key] = args[key]
+        with _global_context_lock:
+            _global_context = _global_context.child(args)
     except:
         pass
 
 
-def reset_context():
-    global global_context
-    global_context = {}
+def reset_global_context():
+    global _global_context
+    _global_context = _EMPTY_FIELDS
 
 
-def get_context():
-    clone = {}
+def _scoped_context():
+    # Returns the context of the current 'log_context' scope or asyncio task
+    # (each task runs in its own copy of the contextvars), or None.
+    scoped = _context.get()
+    if scoped is not None:
+        return scoped
     try:
-        clone = copy.deepcopy(global_context)
+        if asyncio.current_task() is not None:
+            return _EMPTY_FIELDS
+    except RuntimeError:
+        pass
+    return None
+
+
+def set_context(**args):
+    # Outside of a 'log_context' scope and of an asyncio task, the keys are set
+    # process-wide (e.g., at startup). Otherwise, they are only set until the
+    # scope exits or in the current task.
+    scoped = _scoped_context()
+    if scoped is None:
+        set_global_context(**args)
+        return
+    try:
+        _context.set(scoped.child(args))
     except:
         pass
-    return clone
 
 
-def log(
-    level="INFO",
-    message=None,
-    code=None,
-    time=None,
-    op_id=None,
-    test=None,
-    metric=None,
-    unit=None,
-    data=None,
-    errors=None,
-    print_mock=None,
-    **args,
+def reset_context():
+    if _scoped_context() is None:
+        reset_global_context()
+    else:
+        _context.set(_EMPTY_FIELDS)
+
+
+def get_context():
+    return dict(_get_context().merged)
+
+
+class log_context:
+    # Adds keys to the context of the current thread or asyncio task until the
+    # 'with' block exits. Can also be used as a decorator.
+    def __init__(self, **args):
+        self._args = args
+        self._tokens = []
+
+    def __enter__(self):
+        scoped = _context.get()
+        scoped = (scoped if scoped is not None else _EMPTY_FIELDS).child(self._args)
+        self._tokens.append(_context.set(scoped))
+        return self
+
+    def __exit__(self, *exc):
+        _context.reset(self._tokens.pop())
+        return False
+
+    def __call__(self, fn):
+        args = self._args
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*a, **kw):
+                with log_context(**args):
+                    return await fn(*a, **kw)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            with log_context(**args):
+                return fn(*a, **kw)
+
+        return wrapper
+
+
+class _RateLimit:
+    # Token bucket ('rate' lines per second, up to 'burst' lines at once) and/or
+    # probabilistic sampling ('sample' is the probability to keep a line). The
+    # bucket is updated without a lock; a concurrent race can only let a line
+    # or two more through. Suppressed lines are counted in per-thread counters.
+    def __init__(self, kind, key, rate, burst, sample, summary_interval):
+        self.kind = kind
+        self.key = key
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate or 1, 1)
+        self.sample = sample
+        self.summary_interval = summary_interval
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._local = threading.local()
+        self._counters = []
+        self._reported = 0
+        self._summary_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if summary_interval:
+            self._thread = threading.Thread(
+                target=self._run, name="puffy-log-rate-limit", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.summary_interval):
+            try:
+                self.summarize()
+            except:
+                pass
+
+    def allow(self):
+        allowed = True
+        if self.sample is not None and random.random() >= self.sample:
+            allowed = False
+        now = monotonic()
+        if allowed and self.rate is not None:
+            tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if tokens < 1:
+                self._tokens = tokens
+                allowed = False
+            else:
+                self._tokens = tokens - 1
+        if not allowed:
+            counter = getattr(self._local, "counter", None)
+            if counter is None:
+                counter = self._local.counter = [0]
+                self._counters.append(counter)
+            counter[0] += 1
+        return allowed
+
+    def suppressed(self):
+        return sum(c[0] for c in self._counters)
+
+    def summarize(self):
+        if not self._summary_lock.acquire(False):
+            return
+        try:
+            total = self.suppressed()
+            count = total - self._reported
+            self._reported = total
+        finally:
+            self._summary_lock.release()
+        if count > 0:
+            _log(
+                _EMPTY_FIELDS,
+                "WARN",
+                f"suppressed {count} lines for {self.kind} {self.key}",
+                self.key if self.kind == "code" else None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                {"suppressed": count, self.kind: self.key},
+                None,
+                None,
+                None,
+            )
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.summarize()
+
+
+_code_limits = {}
+_level_limits = {}
+_rate_limited = False
+
+
+def set_rate_limit(
+    code=None, level=None, rate=None, burst=None, sample=None, summary_interval=60
 ):
+    global _rate_limited
+    if code is None and level is None:
+        raise Exception("Missing required argument. Set either 'code' or 'level'.")
+    if rate is not None and rate <= 0:
+        raise Exception("'rate' must be strictly positive.")
+    if sample is not None and not (0 <= sample <= 1):
+        raise Exception("'sample' must be between 0 and 1.")
+    if summary_interval is not None and summary_interval <= 0:
+        raise Exception("'summary_interval' must be strictly positive.")
+
+    if code is not None:
+        limits, kind, key = _code_limits, "code", code
+    else:
+        limits, kind, key = _level_limits, "level", _normalize_level(level)
+
+    previous = limits.pop(key, None)
+    if previous is not None:
+        previous.close()
+    if rate is not None or sample is not None:
+        limits[key] = _RateLimit(kind, key, rate, burst, sample, summary_interval)
+    _rate_limited = bool(_code_limits or _level_limits)
+
+
+def clear_rate_limits():
+    global _rate_limited
+    _rate_limited = False
+    for limits in (_code_limits, _level_limits):
+        for limit in list(limits.values()):
+            limit.close()
+        limits.clear()
+
+
+def _flush_suppressed():
+    for limits in (_code_limits, _level_limits):
+        for limit in list(limits.values()):
+            limit.summarize()
+
+
+def _allow(level, code, bound):
     try:
-        level = str.upper(f"{level}").strip()
-        if level == "WARNING":
-            level = "WARN"
-        if level not in LEVELS:
-            level = "INFO"
+        if not code and bound.values:
+            code = bound.merged.get("code")
+        limit = _code_limits.get(code) if code and _code_limits else None
+        if limit is None and _level_limits:
+            limit = _level_limits.get(_normalize_level(level))
+        return limit is None or limit.allow()
+    except:
+        return True
 
-        log_data = _getGlobalMeta()
 
+DEFAULT_METRIC_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+_CLOUDWATCH_UNITS = {
+    "ms": "Milliseconds",
+    "milliseconds": "Milliseconds",
+    "s": "Seconds",
+    "seconds": "Seconds",
+    "us": "Microseconds",
+    "microseconds": "Microseconds",
+    "bytes": "Bytes",
+    "kb": "Kilobytes",
+    "mb": "Megabytes",
+    "count": "Count",
+    "percent": "Percent",
+}
+
+
+class _MetricSeries:
+    __slots__ = ("count", "sum", "min", "max", "bucket_counts", "bucket_sums")
+
+    def __init__(self, size):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.bucket_counts = [0] * size
+        self.bucket_sums = [0] * size
+
+    def add(self, value, bucket):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.bucket_counts[bucket] += 1
+        self.bucket_sums[bucket] += value
+
+
+class _MetricAggregator:
+    # Folds the metric logs sharing the same name (i.e., 'code'), unit and
+    # dimensions into count/sum/min/max and a fixed-bucket histogram. The
+    # snapshot is logged every 'interval' seconds in the CloudWatch Embedded
+    # Metric Format (EMF).
+    def __init__(self, interval, namespace, dimensions, buckets):
+        self.interval = interval
+        self.namespace = namespace
+        self.dimensions = list(dimensions) if dimensions else []
+        self._dimensions = set(self.dimensions)
+        self.buckets = sorted(buckets) if buckets else DEFAULT_METRIC_BUCKETS
+        self._series = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if interval:
+            self._thread = threading.Thread(
+                target=self._run, name="puffy-log-metrics", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except:
+                pass
+
+    def add(
+        self,
+        bound,
+        level,
+        message,
+        code,
+        time,
+        op_id,
+        test,
+        metric,
+        unit,
+        data,
+        errors,
+        args,
+    ):
+        # Returns True when the record is folded (i.e., must not be logged).
         try:
-            for key in global_context:
-                log_data[key] = global_context[key]
+            return self._add(
+                bound,
+                level,
+                message,
+                code,
+                time,
+                op_id,
+                test,
+                metric,
+                unit,
+                data,
+                errors,
+                args,
+            )
         except:
-            pass
+            return False
+
+    def _add(
+        self,
+        bound,
+        level,
+        message,
+        code,
+        time,
+        op_id,
+        test,
+        metric,
+        unit,
+        data,
+        errors,
+        args,
+    ):
+        if isinstance(time, (int, float)) and not isinstance(time, bool):
+            value, unit = time, "ms"
+        elif isinstance(metric, (int, float)) and not isinstance(metric, bool):
+            value = metric
+        else:
+            return False
+        # Only the records carrying nothing but the metric (and its dimensions)
+        # are folded. The others (e.g., errors or warnings) are logged.
+        if message or data or errors or op_id or test:
+            return False
+        if _LEVEL_RANKS[_normalize_level(level)] > _INFO_RANK:
+            return False
+        for key in args:
+            if key not in self._dimensions:
+                return False
+
+        if not code and bound.values:
+            code = bound.merged.get("code")
+        dims = ()
+        if self.dimensions:
+            context = _get_context().merged
+            bound_fields = bound.merged
+            dims = tuple(
+                args.get(d, bound_fields.get(d, context.get(d)))
+                for d in self.dimensions
+            )
+        key = (code or "metric", unit or None, dims)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _MetricSeries(len(self.buckets) + 1)
+            series.add(value, bucket)
+        return True
+
+    def flush(self):
+        with self._lock:
+            series, self._series = self._series, {}
+        timestamp = int(_now() * 1000)
+        for (name, unit, dims), s in series.items():
+            dimensions = {d: v for d, v in zip(self.dimensions, dims) if v is not None}
+            values, counts = [], []
+            for count, total in zip(s.bucket_counts, s.bucket_sums):
+                if count:
+                    values.append(total / count)
+                    counts.append(count)
+            record = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": self.namespace,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [
+                                {
+                                    "Name": name,
+                                    "Unit": _CLOUDWATCH_UNITS.get(
+                                        f"{unit}".lower(), "None"
+                                    ),
+                                }
+                            ],
+                        }
+                    ],
+                },
+                **{f"{k}": v for k, v in dimensions.items()},
+                f"{name}": {"Values": values, "Counts": counts},
+                "stats": {
+                    "count": s.count,
+                    "sum": s.sum,
+                    "min": s.min,
+                    "max": s.max,
+                },
+            }
+            if unit:
+                record["unit"] = unit
+            _log(
+                _EMPTY_FIELDS,
+                "INFO",
+                None,
+                name,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                record,
+            )
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
 
-        log_data["level"] = level
+_aggregator = None
+
+
+def enable_metric_aggregation(
+    interval=60, namespace="puffy", dimensions=None, buckets=None
+):
+    global _aggregator
+    if interval is not None and interval <= 0:
+        raise Exception("'interval' must be strictly positive.")
+    disable_metric_aggregation()
+    _aggregator = _MetricAggregator(interval, namespace, dimensions, buckets)
+
+
+def disable_metric_aggregation():
+    global _aggregator
+    aggregator = _aggregator
+    _aggregator = None
+    if aggregator is not None:
+        aggregator.close()
+
+
+def flush_metrics():
+    aggregator = _aggregator
+    if aggregator is not None:
+        aggregator.flush()
+
+
+class _ErrorAggregator:
+    # Counts the logged errors per fingerprint. Only the first occurrence of an
+    # error in each 'window' (seconds) is logged with its full trace. The other
+    # occurrences are logged as a single '{fingerprint, count}' summary when the
+    # window ends.
+    def __init__(self, window):
+        self.window = window
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if window:
+            self._thread = threading.Thread(
+                target=self._run, name="puffy-log-errors", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.window):
+            try:
+                self.flush()
+            except:
+                pass
+
+    def add(self, level, code, errors):
+        # Returns the fingerprint and whether the full error must be logged.
         try:
-            for key in args:
-                try:
-                    log_data[key] = args[key]
-                except:
-                    pass
+            err = (
+                errors
+                if isinstance(errors, StackedException)
+                else StackedException(errors)
+            )
+            fingerprint = err.fingerprint()
         except:
-            pass
+            return None, True
+        with self._lock:
+            entry = self._counts.get(fingerprint)
+            if entry is None:
+                self._counts[fingerprint] = [level, code, 0]
+                return fingerprint, True
+            entry[2] += 1
+        return fingerprint, False
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        for fingerprint, (level, code, count) in counts.items():
+            if count:
+                _log(
+                    _EMPTY_FIELDS,
+                    level,
+                    f"{count} more occurrences of error {fingerprint}",
+                    code,
+                    None,
+                    None,
+                    None,
+                    None,
+                    None,
+                    None,
+                    None,
+                    None,
+                    {"fingerprint": fingerprint, "count": count},
+                )
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+_error_aggregator = None
+
+
+def enable_error_aggregation(window=60):
+    global _error_aggregator
+    if window is not None and window <= 0:
+        raise Exception("'window' must be strictly positive.")
+    disable_error_aggregation()
+    _error_aggregator = _ErrorAggregator(window)
+
+
+def disable_error_aggregation():
+    global _error_aggregator
+    aggregator = _error_aggregator
+    _error_aggregator = None
+    if aggregator is not None:
+        aggregator.close()
+
+
+def flush_errors():
+    aggregator = _error_aggregator
+    if aggregator is not None:
+        aggregator.flush()
+
+
+def _log(
+    bound,
+    level,
+    message,
+    code,
+    time,
+    op_id,
+    test,
+    metric,
+    unit,
+    data,
+    errors,
+    print_mock,
+    args,
+):
+    try:
+        level = _normalize_level(level)
+
+        if callable(message):
+            message = message()
+        if callable(data):
+            data = data()
+        if callable(errors):
+            errors = errors()
+
+        fingerprint = None
+        if errors and _error_aggregator is not None:
+            fingerprint, first = _error_aggregator.add(level, code, errors)
+            if not first:
+                return
+
+        fields = bound.join(_get_context().join(_getGlobalMeta()))
+        log_data = {"level": level}
+
+        if args:
+            try:
+                for key in args:
+                    try:
+                        log_data[key] = args[key]
+                    except:
+                        pass
+            except:
+                pass
 
         if message and type(message) == str:
             log_data["message"] = message
@@ -152,9 +1135,14 @@ def log(
         if data and data is not None:
             log_data["data"] = data
 
+        if fingerprint is not None:
+            log_data["fingerprint"] = fingerprint
+
         if errors and errors is not None:
             try:
-                if isinstance(errors, StackedException):
+                if _errors_format == "structured":
+                    log_data["errors"] = _structure_errors(errors)
+                elif isinstance(errors, StackedException):
                     log_data["errors"] = errors.stringify()
                 elif isinstance(errors, list) or isinstance(errors, tuple):
                     if len(errors) > 0:
@@ -166,12 +1154,9 @@ def log(
             except:
                 pass
 
-        log_str = json.dumps(log_data, default=str)
+        log_str = _dumps(fields, log_data)
 
-        if print_mock and print_mock is not None:
-            print_mock(log_str)
-        else:
-            print(log_str)
+        _emit(log_str, print_mock)
     except Exception as e:
         try:
             log_str = json.dumps(
@@ -186,12 +1171,294 @@ def log(
                     },
                     "errors": str(e),
                 },
-                default=str,
+                default=_json_default,
             )
-            if print_mock and print_mock is not None:
-                print_mock(log_str)
-            else:
-                print(log_str)
+            _emit(log_str, print_mock)
         except:
             pass
         pass
+
+
+def log(
+    level="INFO",
+    message=None,
+    code=None,
+    time=None,
+    op_id=None,
+    test=None,
+    metric=None,
+    unit=None,
+    data=None,
+    errors=None,
+    print_mock=None,
+    **args,
+):
+    if _min_rank and not is_enabled(level):
+        return
+    if _rate_limited and not _allow(level, code, _EMPTY_FIELDS):
+        return
+    if _aggregator is not None and _aggregator.add(
+        _EMPTY_FIELDS,
+        level,
+        message,
+        code,
+        time,
+        op_id,
+        test,
+        metric,
+        unit,
+        data,
+        errors,
+        args,
+    ):
+        return
+    _log(
+        _EMPTY_FIELDS,
+        level,
+        message,
+        code,
+        time,
+        op_id,
+        test,
+        metric,
+        unit,
+        data,
+        errors,
+        print_mock,
+        args,
+    )
+
+
+class Logger:
+    # Logger with static fields (e.g., 'code', 'op_id' or any other key) that are
+    # serialized once by 'bind'. Each 'log' call only serializes its own fields.
+    def __init__(self, fields=_EMPTY_FIELDS, print_mock=None):
+        self._fields = fields
+        self._print_mock = print_mock
+
+    @property
+    def fields(self):
+        return dict(self._fields.merged)
+
+    def bind(self, print_mock=None, **fields):
+        values = {k: v for k, v in fields.items() if v is not None}
+        return Logger(
+            self._fields.child(values),
+            print_mock if print_mock is not None else self._print_mock,
+        )
+
+    def timed(self, code=None, level="INFO", message=None, **fields):
+        return timed(code=code, level=level, message=message, logger=self, **fields)
+
+    def log(
+        self,
+        level="INFO",
+        message=None,
+        code=None,
+        time=None,
+        op_id=None,
+        test=None,
+        metric=None,
+        unit=None,
+        data=None,
+        errors=None,
+        print_mock=None,
+        **args,
+    ):
+        if _min_rank and not is_enabled(level):
+            return
+        if _rate_limited and not _allow(level, code, self._fields):
+            return
+        if _aggregator is not None and _aggregator.add(
+            self._fields,
+            level,
+            message,
+            code,
+            time,
+            op_id,
+            test,
+            metric,
+            unit,
+            data,
+            errors,
+            args,
+        ):
+            return
+        _log(
+            self._fields,
+            level,
+            message,
+            code,
+            time,
+            op_id,
+            test,
+            metric,
+            unit,
+            data,
+            errors,
+            print_mock if print_mock is not None else self._print_mock,
+            args,
+        )
+
+
+def bind(print_mock=None, **fields):
+    return Logger().bind(print_mock=print_mock, **fields)
+
+
+# Stack of the '(timer, start, parent)' entered 'with' blocks. Each thread and
+# asyncio task has its own, so that a timer can be reused concurrently.
+_timed_starts = contextvars.ContextVar("puffy_timed_starts", default=None)
+
+
+class timed:
+    # Measures the duration of a block of code, or of a sync or async function,
+    # and logs it with the 'time' input (i.e., 'metric' in ms). The level and
+    # rate limit checks are done upfront so that a muted timer costs almost
+    # nothing. Failures are logged at the ERROR level (at least), even when the
+    # timer's level is muted.
+    __slots__ = (
+        "code",
+        "level",
+        "message",
+        "fields",
+        "_rank",
+        "_bound",
+        "_print_mock",
+    )
+
+    def __init__(self, code=None, level="INFO", message=None, logger=None, **fields):
+        self.code = code
+        self.level = level
+        self.message = message
+        self.fields = fields
+        rank = _LEVEL_RANKS.get(level)
+        self._rank = rank if rank is not None else _LEVEL_RANKS[_normalize_level(level)]
+        if logger is None:
+            self._bound = _EMPTY_FIELDS
+            self._print_mock = None
+        else:
+            self._bound = logger._fields
+            self._print_mock = logger._print_mock
+
+    def _start(self):
+        if _min_rank > self._rank:
+            return None
+        if _rate_limited and not _allow(self.level, self.code, self._bound):
+            return None
+        return perf_counter_ns()
+
+    def _stop(self, start, error):
+        if error is not None:
+            self._fail(start, error)
+            return
+        elapsed = (perf_counter_ns() - start) / 1e6
+        if _aggregator is not None and _aggregator.add(
+            self._bound,
+            self.level,
+            self.message,
+            self.code,
+            elapsed,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            self.fields,
+        ):
+            return
+        args = dict(self.fields)
+        args["success"] = True
+        _log(
+            self._bound,
+            self.level,
+            self.message,
+            self.code,
+            elapsed,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            self._print_mock,
+            args,
+        )
+
+    def _fail(self, start, error):
+        # Without 'start' (i.e., muted timer), the duration is unknown.
+        level = self.level if self._rank > _ERROR_RANK else "ERROR"
+        if start is None:
+            if _min_rank > _ERROR_RANK or (
+                _rate_limited and not _allow(level, self.code, self._bound)
+            ):
+                return
+            elapsed = None
+        else:
+            elapsed = (perf_counter_ns() - start) / 1e6
+        args = dict(self.fields)
+        args["success"] = False
+        _log(
+            self._bound,
+            level,
+            self.message,
+            self.code,
+            elapsed,
+            None,
+            None,
+            None,
+            None,
+            None,
+            StackedException(error),
+            self._print_mock,
+            args,
+        )
+
+    def __enter__(self):
+        top = _timed_starts.get()
+        start = None if _min_rank > self._rank else self._start()
+        # A muted timer only pushes its (empty) start when it is nested in itself.
+        if start is not None or (top is not None and top[0] is self):
+            _timed_starts.set((self, start, top))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        top = _timed_starts.get()
+        start = None
+        if top is not None and top[0] is self:
+            _timed_starts.set(top[2])
+            start = top[1]
+        if start is not None or exc is not None:
+            self._stop(start, exc)
+        return False
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*a, **kw):
+                start = self._start()
+                try:
+                    data = await fn(*a, **kw)
+                except BaseException as error:
+                    self._stop(start, error)
+                    raise
+                if start is not None:
+                    self._stop(start, None)
+                return data
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            start = self._start()
+            try:
+                data = fn(*a, **kw)
+            except BaseException as error:
+                self._stop(start, error)
+                raise
+            if start is not None:
+                self._stop(start, None)
+            return data
+
+        return wrapper
@@ -0,0 +1,248 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import sys
+import time
+import socket
+import threading
+from abc import ABC, abstractmethod
+
+
+class Sink(ABC):
+    # Base class of all the 'log' outputs. Subclasses only need to implement
+    # 'write', which receives already encoded bytes (one or many lines).
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def write_lines(self, lines):
+        self.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    @abstractmethod
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class _BufferedSink(Sink):
+    # With a 'buffer_size', the lines are written when the buffer is full and,
+    # so that quiet processes do not hold them, every 'flush_interval' seconds
+    # by a background thread started on the first buffered write.
+    def __init__(self, buffer_size=0, flush_interval=1):
+        super().__init__()
+        self.buffer_size = buffer_size if buffer_size and buffer_size > 0 else 0
+        self.flush_interval = (
+            flush_interval if flush_interval and flush_interval > 0 else None
+        )
+        self._buffer = bytearray()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except:
+                pass
+
+    def _stop_timer(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    @abstractmethod
+    def _write(self, data):
+        pass
+
+    def write(self, data):
+        with self._lock:
+            if not self.buffer_size:
+                self._write(data)
+                return
+            self._buffer += data
+            if len(self._buffer) >= self.buffer_size:
+                self._flush_buffer()
+            elif (
+                self._thread is None and self.flush_interval and not self._stop.is_set()
+            ):
+                self._thread = threading.Thread(
+                    target=self._run, name="puffy-log-sink", daemon=True
+                )
+                self._thread.start()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._write(data)
+
+    def flush(self):
+        with self._lock:
+            self._flush_buffer()
+
+    def close(self):
+        self._stop_timer()
+        super().close()
+
+
+class StdoutSink(_BufferedSink):
+    # Writes straight to the stdout file descriptor, bypassing 'print' and the
+    # 'sys.stdout' text layer.
+    def __init__(self, buffer_size=0, fd=None, flush_interval=1):
+        super().__init__(buffer_size, flush_interval)
+        self._fd = fd
+
+    def _write(self, data):
+        fd = self._fd if self._fd is not None else sys.stdout.fileno()
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+class FileSink(_BufferedSink):
+    # Append-only file. When 'max_bytes' (size) or 'interval' (seconds) is set,
+    # the file is rotated to '<path>.1', '<path>.2', ... up to 'backup_count'.
+    def __init__(
+        self,
+        path,
+        max_bytes=None,
+        interval=None,
+        backup_count=5,
+        buffer_size=0,
+        flush_interval=1,
+    ):
+        super().__init__(buffer_size, flush_interval)
+        self.path = path
+        self.max_bytes = max_bytes if max_bytes and max_bytes > 0 else None
+        self.interval = interval if interval and interval > 0 else None
+        self.backup_count = backup_count if backup_count and backup_count > 0 else 0
+        self._fd = None
+        self._size = 0
+        self._rollover_at = None
+        self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = os.fstat(self._fd).st_size
+        if self.interval:
+            self._rollover_at = time.time() + self.interval
+
+    def _should_rotate(self, size):
+        if self.max_bytes and self._size and self._size + size > self.max_bytes:
+            return True
+        if self._rollover_at is not None and time.time() >= self._rollover_at:
+            return True
+        return False
+
+    def _rotate(self):
+        os.close(self._fd)
+        self._fd = None
+        if self.backup_count:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, data):
+        if self._fd is None:
+            self._open()
+        if self._should_rotate(len(data)):
+            self._rotate()
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+        self._size += len(data)
+
+    def close(self):
+        self._stop_timer()
+        with self._lock:
+            self._flush_buffer()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class UnixSocketSink(Sink):
+    # Sends the logs to a local collector listening on a UNIX socket. With the
+    # "dgram" kind, each log line is sent as its own datagram.
+    def __init__(self, path, kind="dgram"):
+        super().__init__()
+        if kind not in ["dgram", "stream"]:
+            raise Exception(
+                f"Invalid socket kind '{kind}'. Supported values: dgram, stream."
+            )
+        self.path = path
+        self.kind = kind
+        self._sock = None
+
+    def _connect(self):
+        sock_type = socket.SOCK_DGRAM if self.kind == "dgram" else socket.SOCK_STREAM
+        sock = socket.socket(socket.AF_UNIX, sock_type)
+        try:
+            sock.connect(self.path)
+        except:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def _send(self, send):
+        if self._sock is None:
+            self._connect()
+        try:
+            send(self._sock)
+        except OSError:
+            # The collector may have restarted. Reconnect once and retry.
+            self._disconnect()
+            self._connect()
+            send(self._sock)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except:
+                pass
+            self._sock = None
+
+    def write_lines(self, lines):
+        if self.kind == "stream":
+            return super().write_lines(lines)
+
+        datagrams = [line.encode("utf-8") for line in lines]
+        sent = [0]
+
+        def send(sock):
+            # Resumes after the last delivered datagram when retried.
+            start = sent[0]
+            for datagram in datagrams[start:]:
+                sock.send(datagram)
+                sent[0] += 1
+
+        with self._lock:
+            self._send(send)
+
+    def write(self, data):
+        with self._lock:
+            if self.kind == "stream":
+                self._send(lambda sock: sock.sendall(data))
+            else:
+                self._send(lambda sock: sock.send(data))
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
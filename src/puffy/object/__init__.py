@@ -4,32 +4,329 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
+from array import array
+from itertools import islice
+from collections import deque
+from collections.abc import Mapping, MutableMapping, MutableSequence
 
-def dotProps(obj, keys, set_value=None, set_mode=False):
-    if not keys or not obj or not isinstance(obj, dict) or not isinstance(keys, str):
-        return None
+PATH_CACHE_SIZE = 1024
+
+
+def dotProps(obj, keys, set_value=None, set_mode=False, default=None, vivify=False):
+    if not keys or not obj or not isinstance(keys, str):
+        return None if set_mode or vivify else default
+
+    path = compile_path(keys)
+    if set_mode:
+        return path.set(obj, set_value)
+    return path.get(obj, default, vivify)
+
+
+_MISSING = object()
+WILDCARD = "*"
+
+
+def _index(key):
+    # The keys made of digits (e.g., "0" or "-1") are also list indexes.
+    # 'isdigit' is not used: it also accepts digits that 'int' rejects (e.g., "²").
+    digits = key[1:] if key.startswith("-") else key
+    return int(key) if digits.isdecimal() else None
+
+
+def _step(value, key, index):
+    if isinstance(value, dict) or isinstance(value, Mapping):
+        return value.get(key, _MISSING)
+    if index is not None and isinstance(value, (list, tuple)):
+        try:
+            return value[index]
+        except IndexError:
+            return _MISSING
+    return _MISSING
+
+
+def _items(value):
+    if isinstance(value, dict) or isinstance(value, Mapping):
+        return value.values()
+    if isinstance(value, (list, tuple)):
+        return value
+    return ()
+
+
+def _fits(value, key, index):
+    # Whether 'value' can be walked with 'key' without being replaced.
+    if isinstance(value, dict):
+        return True
+    if isinstance(value, list):
+        return key == WILDCARD or (
+            index is not None and -len(value) <= index < len(value)
+        )
+    return False
+
+
+class DotPath:
+    # Dotted path (e.g., "a.b.c") split once. A key made of digits is also a list
+    # index (e.g., "items.0.price") and "*" matches all the items of a list or
+    # all the values of a dict. Reads never change the object, unless 'vivify'
+    # is set. Then, like 'set', the missing (or non-dict) intermediate keys are
+    # replaced with {} and a missing leaf is set to None. Lists are never
+    # replaced: 'set' returns None without writing instead.
+    __slots__ = ("path", "keys", "wildcard", "_steps", "_simple", "_parents", "_leaf")
+
+    def __init__(self, path):
+        if not path or not isinstance(path, str):
+            raise Exception("'path' must be a non-empty string.")
+        self.path = path
+        self.keys = tuple(path.split("."))
+        self.wildcard = WILDCARD in self.keys
+        self._steps = tuple((key, _index(key)) for key in self.keys)
+        self._simple = not self.wildcard and all(i is None for _, i in self._steps)
+        self._parents = self.keys[:-1]
+        self._leaf = self.keys[-1]
 
-    value = obj
-    _keys = keys.split(".")
-    keys_last_index = len(_keys) - 1
-    for idx, key in enumerate(_keys):
-        last_key = idx == keys_last_index
-        if key in value:
-            if last_key:
-                if set_mode:
-                    value[key] = set_value
-            elif not isinstance(value[key], dict):
-                value[key] = {}
-
-            value = value[key]
+    def _parent(self, obj):
+        value = obj
+        for key in self._parents:
+            child = value.get(key)
+            if not isinstance(child, dict):
+                if isinstance(child, list):
+                    # A list is never replaced, e.g., by a key that is not an index.
+                    return None
+                child = value[key] = {}
+            value = child
+        return value
+
+    def _set(self, value, pos, new_value):
+        # Returns whether the value was set at least once.
+        key, index = self._steps[pos]
+        last = pos == len(self._steps) - 1
+        if key == WILDCARD:
+            slots = list(value) if isinstance(value, dict) else range(len(value))
         else:
-            if last_key:
-                value[key] = set_value if set_mode else None
+            slots = (index if isinstance(value, list) else key,)
+        done = False
+        for slot in slots:
+            if last:
+                value[slot] = new_value
+                done = True
+                continue
+            child = value.get(slot) if isinstance(value, dict) else value[slot]
+            if not _fits(child, *self._steps[pos + 1]):
+                # Wildcards only go through the existing dicts and lists, and a
+                # list is never replaced (e.g., for an out of range index).
+                if key == WILDCARD or isinstance(child, list):
+                    continue
+                child = value[slot] = {}
+            done = self._set(child, pos + 1, new_value) or done
+        return done
+
+    def _collect(self, obj):
+        matches = []
+        steps = self._steps
+        size = len(steps)
+        queue = deque([(obj, 0)])
+        while queue:
+            value, pos = queue.popleft()
+            if pos == size:
+                matches.append(value)
+                continue
+            key, index = steps[pos]
+            if key == WILDCARD:
+                queue.extend((item, pos + 1) for item in _items(value))
             else:
-                value[key] = {}
-            value = value[key]
+                value = _step(value, key, index)
+                if value is not _MISSING:
+                    queue.append((value, pos + 1))
+        return matches
 
-    return value
+    def get(self, obj, default=None, vivify=False):
+        # A path with wildcards returns the list of all the matching values.
+        if self.wildcard:
+            return self._collect(obj)
+
+        if vivify:
+            if not self._simple:
+                value = self.get(obj, _MISSING)
+                if value is _MISSING:
+                    self.set(obj, None)
+                    return None
+                return value
+            if not isinstance(obj, dict):
+                return None
+            value = self._parent(obj)
+            if value is None:
+                return None
+            leaf = self._leaf
+            if leaf in value:
+                return value[leaf]
+            value[leaf] = None
+            return None
+
+        # Stops at the first missing key. Also works on read-only mappings.
+        value = obj
+        for key, index in self._steps:
+            if isinstance(value, dict) or isinstance(value, Mapping):
+                value = value.get(key, _MISSING)
+                if value is _MISSING:
+                    return default
+            elif index is not None and isinstance(value, (list, tuple)):
+                try:
+                    value = value[index]
+                except IndexError:
+                    return default
+            else:
+                return default
+        return value
+
+    def set(self, obj, value):
+        if self._simple:
+            if not isinstance(obj, dict):
+                return None
+            parent = self._parent(obj)
+            if parent is None:
+                return None
+            parent[self._leaf] = value
+            return value
+        if not _fits(obj, *self._steps[0]):
+            return None
+        return value if self._set(obj, 0, value) else None
+
+    def has(self, obj):
+        if self.wildcard:
+            return len(self._collect(obj)) > 0
+        return self.get(obj, _MISSING) is not _MISSING
+
+    def __repr__(self):
+        return f"DotPath({self.path!r})"
+
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def compile_path(path):
+    return DotPath(path)
+
+
+class _PathNode:
+    __slots__ = ("children", "wildcard", "path", "index", "multi", "leaf")
+
+    def __init__(self, key=None, multi=False):
+        self.children = {}
+        self.wildcard = None
+        self.path = None
+        self.index = _index(key) if key else None
+        self.multi = multi
+        self.leaf = False
+
+
+class DotPathTrie:
+    # Set of dotted paths compiled into a prefix tree, so the keys they share
+    # (e.g., "request.headers") are only walked once per document.
+    __slots__ = ("paths", "_root", "_multi", "_simple")
+
+    def __init__(self, paths):
+        self.paths = tuple(paths)
+        self._root = _PathNode()
+        self._multi = []
+        self._simple = True
+        nodes = []
+        for path in self.paths:
+            dot_path = compile_path(path)
+            self._simple = self._simple and dot_path._simple
+            node = self._root
+            for key in dot_path.keys:
+                if key == WILDCARD:
+                    child = node.wildcard
+                    if child is None:
+                        child = node.wildcard = _PathNode(key, True)
+                else:
+                    child = node.children.get(key)
+                    if child is None:
+                        child = node.children[key] = _PathNode(key, node.multi)
+                nodes.append(child)
+                node = child
+            node.path = path
+            if node.multi:
+                self._multi.append(path)
+        for node in nodes:
+            # Leaves are read without being queued.
+            node.leaf = (
+                node.path is not None
+                and not node.multi
+                and not node.children
+                and node.wildcard is None
+            )
+
+    def get(self, obj, default=None):
+        # Read-only. Returns a dict with one value per path (a list of values
+        # for the paths with wildcards).
+        result = dict.fromkeys(self.paths, default)
+        for path in self._multi:
+            result[path] = []
+        # Breadth-first, so the values matched by wildcards keep their order.
+        queue = [(self._root, obj)]
+        position = 0
+        while position < len(queue):
+            node, value = queue[position]
+            position += 1
+            if node.path is not None and not node.leaf:
+                if node.multi:
+                    result[node.path].append(value)
+                else:
+                    result[node.path] = value
+            is_dict = isinstance(value, dict)
+            for key, child in node.children.items():
+                child_value = (
+                    value.get(key, _MISSING)
+                    if is_dict
+                    else _step(value, key, child.index)
+                )
+                if child_value is _MISSING:
+                    continue
+                if child.leaf:
+                    result[child.path] = child_value
+                else:
+                    queue.append((child, child_value))
+            if node.wildcard is not None:
+                child = node.wildcard
+                queue.extend((child, item) for item in _items(value))
+        return result
+
+    def set(self, obj, values):
+        # Same behavior as 'DotPath.set' for each path. When a path is the prefix
+        # of another one, its value is set first.
+        if not self._simple:
+            for path in self.paths:
+                compile_path(path).set(obj, values[path])
+            return values
+        if not isinstance(obj, dict):
+            return None
+        stack = [(self._root, obj)]
+        while stack:
+            node, value = stack.pop()
+            for key, child in node.children.items():
+                if child.path is not None:
+                    value[key] = values[child.path]
+                if child.children:
+                    child_value = value.get(key)
+                    if isinstance(child_value, list):
+                        continue
+                    if not isinstance(child_value, dict):
+                        child_value = value[key] = {}
+                    stack.append((child, child_value))
+        return values
+
+    def __repr__(self):
+        return f"DotPathTrie({list(self.paths)!r})"
+
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def _compile_paths(paths):
+    return DotPathTrie(paths)
+
+
+def compile_paths(paths):
+    if isinstance(paths, DotPathTrie):
+        return paths
+    return _compile_paths(tuple(paths))
 
 
 class JSON(dict):
@@ -38,8 +335,280 @@ class JSON(dict):
         value = self[key] = type(self)()
         return value
 
-    def g(self, keys):
-        return dotProps(self, keys)
+    def g(self, keys, default=None, vivify=False):
+        if not keys or not self or not isinstance(keys, str):
+            return None if vivify else default
+        return compile_path(keys).get(self, default, vivify)
+
+    def s(self, keys, value):
+        if not keys or not self or not isinstance(keys, str):
+            return None
+        return compile_path(keys).set(self, value)
+
+    def g_many(self, paths, default=None):
+        return compile_paths(paths).get(self, default)
+
+    def s_many(self, values):
+        return compile_paths(values).set(self, values)
+
+
+def _cached_view(views, key, value):
+    # The cached view is dropped when the underlying value was replaced.
+    if not isinstance(value, dict) and not isinstance(value, list):
+        return value
+    view = views.get(key)
+    if view is None or view._data is not value:
+        view = views[key] = (
+            JSONView(value) if isinstance(value, dict) else JSONListView(value)
+        )
+    return view
+
+
+def _raw(obj):
+    if isinstance(obj, dict) or isinstance(obj, list):
+        return obj
+    if isinstance(obj, JSONView) or isinstance(obj, JSONListView):
+        return obj._data
+    return obj
+
+
+def unwrap(obj):
+    # O(1). Also usable as the 'default' function of 'json.dumps', e.g.,
+    # json.dumps(view, default=unwrap).
+    if isinstance(obj, JSONView) or isinstance(obj, JSONListView):
+        return obj._data
+    if obj is None or isinstance(obj, (dict, list, tuple, str, int, float)):
+        return obj
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JSONView(MutableMapping):
+    # Same behavior as 'JSON', without copying the dict. The nested dicts and
+    # lists are wrapped in views on first access, and those views are cached.
+    __slots__ = ("_data", "_views")
+
+    def __init__(self, data=None):
+        data = {} if data is None else _raw(data)
+        if not isinstance(data, dict):
+            raise Exception(
+                f"'JSONView' only wraps dicts. Found {type(data).__name__} instead."
+            )
+        self._data = data
+        self._views = {}
+
+    def __getitem__(self, key):
+        data = self._data
+        if key in data:
+            value = data[key]
+        else:
+            value = data[key] = {}
+        return _cached_view(self._views, key, value)
+
+    def __setitem__(self, key, value):
+        self._data[key] = _raw(value)
+        self._views.pop(key, None)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._views.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, JSONView):
+            other = other._data
+        return self._data == other
+
+    def __repr__(self):
+        return f"JSONView({self._data!r})"
+
+    def get(self, key, default=None):
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        return _cached_view(self._views, key, value)
+
+    def unwrap(self):
+        return self._data
+
+    def g(self, keys, default=None, vivify=False):
+        if not keys or not isinstance(keys, str):
+            return None if vivify else default
+        return compile_path(keys).get(self._data, default, vivify)
 
     def s(self, keys, value):
-        return dotProps(self, keys, value, True)
+        if not keys or not isinstance(keys, str):
+            return None
+        return compile_path(keys).set(self._data, _raw(value))
+
+    def g_many(self, paths, default=None):
+        return compile_paths(paths).get(self._data, default)
+
+    def s_many(self, values):
+        return compile_paths(values).set(self._data, values)
+
+
+class JSONListView(MutableSequence):
+    __slots__ = ("_data", "_views")
+
+    def __init__(self, data=None):
+        data = [] if data is None else _raw(data)
+        if not isinstance(data, list):
+            raise Exception(
+                f"'JSONListView' only wraps lists. Found {type(data).__name__} instead."
+            )
+        self._data = data
+        self._views = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return JSONListView(self._data[index])
+        value = self._data[index]
+        return _cached_view(
+            self._views, index if index >= 0 else index + len(self._data), value
+        )
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._data[index] = [_raw(x) for x in value]
+            self._views.clear()
+        else:
+            self._data[index] = _raw(value)
+            self._views.pop(index if index >= 0 else index + len(self._data), None)
+
+    def __delitem__(self, index):
+        del self._data[index]
+        self._views.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        views = self._views
+        for index, value in enumerate(self._data):
+            yield _cached_view(views, index, value)
+
+    def __eq__(self, other):
+        if isinstance(other, JSONListView):
+            other = other._data
+        return self._data == other
+
+    def __repr__(self):
+        return f"JSONListView({self._data!r})"
+
+    def insert(self, index, value):
+        self._data.insert(index, _raw(value))
+        self._views.clear()
+
+    def unwrap(self):
+        return self._data
+
+
+def _import_numpy(enabled):
+    # NumPy is optional. It is only imported when the columns are extracted.
+    if enabled is False:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        if enabled:
+            raise Exception(
+                "NumPy is not installed. Install it with 'pip install numpy'."
+            )
+        return None
+    return numpy
+
+
+def _walk_columns(node, values, result):
+    # Column-major walk of the trie: each key is read once per document for all
+    # the paths that share it.
+    for key, child in node.children.items():
+        index = child.index
+        child_values = [
+            value.get(key, _MISSING)
+            if type(value) is dict
+            else _step(value, key, index)
+            for value in values
+        ]
+        if child.path is not None:
+            result[child.path] = child_values
+        if child.children:
+            _walk_columns(child, child_values, result)
+
+
+def extract_columns(
+    documents,
+    paths,
+    batch_size=10000,
+    default=None,
+    defaults=None,
+    types=None,
+    numpy=None,
+):
+    # Yields one dict of columns (one per path) per batch of 'batch_size'
+    # documents, so only one batch is held at a time. A path typed with an
+    # 'array' typecode (e.g., "d" or "q") is stored in an 'array' (a NumPy array
+    # when NumPy is installed). The other columns are lists. The missing values
+    # are replaced with 'defaults[path]' or 'default'.
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise Exception("'batch_size' must be a strictly positive integer.")
+    np = _import_numpy(numpy)
+    types = types or {}
+    defaults = defaults or {}
+    columns = []
+    for path in dict.fromkeys(paths):
+        dot_path = compile_path(path)
+        typecode = types.get(path)
+        missing = defaults.get(path, default)
+        if typecode:
+            if dot_path.wildcard:
+                raise Exception(f"The path '{path}' has wildcards. It cannot be typed.")
+            if missing is None:
+                if typecode not in "fd":
+                    raise Exception(
+                        f"Missing 'default' value for the integer column '{path}'."
+                    )
+                missing = float("nan")
+        columns.append((path, dot_path, typecode, missing))
+    trie = compile_paths(
+        path for path, dot_path, _, _ in columns if not dot_path.wildcard
+    )
+
+    items = iter(documents)
+    first = True
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch and not first:
+            break
+        first = False
+        values = {}
+        _walk_columns(trie._root, batch, values)
+        result = {}
+        for path, dot_path, typecode, missing in columns:
+            if dot_path.wildcard:
+                get = dot_path.get
+                result[path] = [get(x) for x in batch]
+                continue
+            column = values[path]
+            if typecode:
+                column = [missing if x is _MISSING or x is None else x for x in column]
+                column = array(typecode, column)
+                if np is not None:
+                    column = (
+                        np.frombuffer(column, dtype=typecode)
+                        if len(column)
+                        else np.zeros(0, dtype=typecode)
+                    )
+            else:
+                column = [missing if x is _MISSING else x for x in column]
+            result[path] = column
+        yield result
+        if len(batch) < batch_size:
+            break
@@ -17,10 +17,30 @@
 import sys
 import re
 import asyncio
+import inspect
+import gc
+import weakref
+import pickle
+import copy
+import json
+import time
+import functools
 
 sys.path.append(".")  # noqa # Adds higher directory to python modules path.
 
-from src.puffy.error import catch_errors, async_catch_errors, StackedException as e
+from src.puffy.error import (
+    catch_errors,
+    async_catch_errors,
+    set_stringify_limits,
+    set_detach_frames,
+    batch_exec,
+    async_batch_exec,
+    RetryPolicy,
+    RetryBudget,
+    CircuitBreaker,
+    CircuitOpenError,
+    StackedException as e,
+)
 
 
 def test_catch_errors_basic():
@@ -280,3 +300,588 @@ def test_catch_errors_stringify_stack_async_await():
     assert error_msgs[1] == "As expected, it failed for Peter (age:32)"
     assert error_msgs[2] == "Should fail again"
     assert error_msgs[3] == "Failed again"
+
+
+def test_catch_errors_function_location():
+    line = inspect.currentframe().f_lineno + 2
+
+    @catch_errors("Should fail")
+    def fail():
+        raise Exception("Failed")
+
+    line_async = inspect.currentframe().f_lineno + 2
+
+    @async_catch_errors("Should fail")
+    async def fail_async():
+        raise Exception("Failed")
+
+    err, _ = fail()
+    err_async, _ = asyncio.run(fail_async())
+
+    assert f'File "{__file__}", line {line}, in fail\n' in err.stringify()
+    assert (
+        f'File "{__file__}", line {line_async}, in fail_async\n'
+        in err_async.stringify()
+    )
+
+
+def test_stringify_memoized_and_limited():
+    def ping(n):
+        if n == 0:
+            raise Exception("Deep failure")
+        return pong(n - 1)
+
+    def pong(n):
+        return ping(n)
+
+    err, _ = catch_errors("Should fail")(ping)(40)
+
+    full = err.stringify()
+    assert err.stringify() is full
+    assert full.count("in ping") > 20
+
+    limited = err.stringify(max_frames=5)
+    assert "frames omitted]" in limited
+    # 5 frames for "Deep failure" and the wrapped function's location for "Should fail".
+    assert limited.count('  File "') == 6
+
+    collapsed = err.stringify(collapse_recursion=True)
+    assert "[Previous 2 frames repeated" in collapsed
+    assert collapsed.count("in pong") < 5
+    assert collapsed.endswith('raise Exception("Deep failure")\n')
+
+    truncated = err.stringify(max_bytes=200)
+    assert len(truncated.encode("utf-8")) <= 200
+    assert truncated.endswith("[... truncated]")
+
+    set_stringify_limits(max_frames=5)
+    try:
+        assert err.stringify() == limited
+    finally:
+        set_stringify_limits()
+    assert err.stringify() == full
+
+
+def test_StackedException_nested_iterables():
+    err = e("a", ["b", ("c", ["d"])], e("x", Exception("y")))
+    assert [str(x) for x in err.stack] == ["a", "b", "c", "d", "x", "y"]
+    assert len(err.stack) == 6
+    assert str(err.stack[-1]) == "y"
+    assert [str(x) for x in err.stack[1:3]] == ["b", "c"]
+    assert err.stack == list(err.stack)
+    assert str(err) == "a"
+
+
+def test_StackedException_deep_chain():
+    err = e("level 0")
+    for i in range(1, 2000):
+        err = e(f"level {i}", err)
+
+    assert len(err.stack) == 2000
+    assert str(err.stack[0]) == "level 1999"
+    assert str(err.stack[1999]) == "level 0"
+    assert [str(x) for x in err.stack][:3] == ["level 1999", "level 1998", "level 1997"]
+
+
+class Payload:
+    pass
+
+
+def test_catch_errors_detach_frames():
+    refs = []
+
+    def make_fail(**options):
+        @catch_errors("Should fail", **options)
+        def fail():
+            payload = Payload()
+            refs.append(weakref.ref(payload))
+            err, _ = fail_again()
+            raise e(err)
+
+        @catch_errors("Should fail again", **options)
+        def fail_again():
+            raise Exception("Failed again")
+
+        return fail
+
+    attached, _ = make_fail()()
+    detached, _ = make_fail(detach_frames=True)()
+    gc.collect()
+
+    assert refs[0]() is not None
+    assert refs[1]() is None
+    assert all(x.__traceback__ is None for x in detached.stack)
+    assert detached.stringify() == attached.stringify()
+
+    set_detach_frames(True, source_lines=False)
+    try:
+        no_source, _ = make_fail()()
+    finally:
+        set_detach_frames(False)
+    gc.collect()
+
+    assert refs[2]() is None
+    assert "raise Exception" not in no_source.stringify()
+    assert "in fail_again" in no_source.stringify()
+
+
+def test_StackedException_serialization():
+    @catch_errors("Should fail")
+    def fail():
+        err, _ = fail_again()
+        raise e(err)
+
+    @catch_errors("Should fail again")
+    def fail_again():
+        raise ValueError("Failed again")
+
+    err, _ = fail()
+    data = err.to_dict()
+
+    assert data["function"]["name"] == "fail"
+    assert data["function"]["file"] == __file__
+    assert [(x["type"], x["message"]) for x in data["errors"]] == [
+        ("Exception", "Should fail"),
+        ("Exception", "Should fail again"),
+        ("ValueError", "Failed again"),
+    ]
+    assert data["errors"][0]["frames"] == []
+    assert data["errors"][2]["frames"][-1]["function"] == "fail_again"
+    assert data["errors"][2]["frames"][-1]["source"].strip() == (
+        'raise ValueError("Failed again")'
+    )
+
+    from_json = e.from_dict(json.loads(json.dumps(data)))
+    from_pickle = pickle.loads(pickle.dumps(err))
+    for rebuilt in [from_json, from_pickle]:
+        assert isinstance(rebuilt, e)
+        assert [str(x) for x in rebuilt.stack] == [str(x) for x in err.stack]
+        assert rebuilt.stringify() == err.stringify()
+        assert rebuilt.to_dict() == data
+
+    # Subclasses are kept, and a shallow copy keeps the original errors.
+    custom = CustomStackedException(err)
+    rebuilt = pickle.loads(pickle.dumps(custom))
+    assert type(rebuilt) is CustomStackedException
+    assert rebuilt.stringify() == custom.stringify()
+    shallow = copy.copy(custom)
+    assert type(shallow) is CustomStackedException
+    assert list(shallow.stack) == list(custom.stack)
+    assert str(shallow) == str(custom)
+    deep = copy.deepcopy(custom)
+    assert type(deep) is CustomStackedException
+    assert deep.to_dict() == custom.to_dict()
+
+
+class CustomStackedException(e):
+    pass
+
+
+def test_batch_exec_threads():
+    def double(x):
+        if x == 3:
+            raise Exception("No threes")
+        time.sleep(0.001 * (10 - x))
+        return x * 2
+
+    results = list(batch_exec(((x,) for x in range(10)), double, max_workers=4))
+    assert [r for _, r in results] == [0, 2, 4, None, 8, 10, 12, 14, 16, 18]
+    err = results[3][0]
+    assert isinstance(err, e)
+    assert str(err) == "No threes"
+
+    unordered = list(
+        batch_exec(range(10), double, max_workers=4, chunk_size=3, ordered=False)
+    )
+    assert sorted(r for _, r in unordered if r is not None) == [
+        0,
+        2,
+        4,
+        8,
+        10,
+        12,
+        14,
+        16,
+        18,
+    ]
+
+    callables = [functools.partial(double, x) for x in range(3)]
+    assert [r for _, r in batch_exec(callables)] == [0, 2, 4]
+
+    # A bad item only fails its own call.
+    items = [functools.partial(abs, -1), "x", functools.partial(abs, -3)]
+    results = list(batch_exec(items, chunk_size=3))
+    assert [r for _, r in results] == [1, None, 3]
+    assert results[0][0] is None and results[2][0] is None
+    assert isinstance(results[1][0], e)
+    assert str(results[1][0]) == (
+        "Invalid item. Expected a function when 'fn' is not set. Found str instead."
+    )
+
+
+def test_batch_exec_is_lazy():
+    consumed = []
+
+    def items():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    results = batch_exec(items(), abs, max_workers=2, chunk_size=10, max_pending=2)
+    err, resp = next(results)
+    assert (err, resp) == (None, 0)
+    assert len(consumed) <= 40
+    results.close()
+
+
+def test_batch_exec_processes():
+    results = list(
+        batch_exec([(7, 2), (1, 0), (9, 3)], divmod, executor="process", max_workers=2)
+    )
+    assert results[0] == (None, (3, 1))
+    assert results[2] == (None, (3, 0))
+    err, resp = results[1]
+    assert resp is None
+    assert isinstance(err, e)
+    assert err.to_dict()["errors"][0]["type"] == "ZeroDivisionError"
+
+
+def test_async_batch_exec():
+    active = []
+    peak = []
+
+    def make(i):
+        async def work():
+            active.append(i)
+            peak.append(len(active))
+            await asyncio.sleep(0.01 * (5 - i % 5))
+            active.remove(i)
+            if i == 7:
+                raise Exception("No sevens")
+            if i == 8:
+                await asyncio.sleep(1)
+            return i
+
+        return work
+
+    async def run(**options):
+        return [
+            x async for x in async_batch_exec((make(i) for i in range(10)), **options)
+        ]
+
+    results = asyncio.run(run(limit=3, timeout=0.5))
+    assert max(peak) <= 3
+    assert sorted(r for _, r in results if r is not None) == [0, 1, 2, 3, 4, 5, 6, 9]
+    errors = sorted(str(err) for err, _ in results if err)
+    assert errors == ["No sevens", "Timed out after 0.5 seconds."]
+
+    async def factories():
+        for i in range(10):
+            yield make(i)
+
+    async def run_fail_fast():
+        return [x async for x in async_batch_exec(factories(), limit=2, fail_fast=True)]
+
+    results = asyncio.run(run_fail_fast())
+    assert str(results[-1][0]) == "No sevens"
+    assert len(results) <= 9
+
+    # A 'TimeoutError' raised by the coroutine is not reported as an expiry.
+    async def inner_timeout():
+        raise asyncio.TimeoutError("Upstream timed out")
+
+    async def run_inner(timeout):
+        return [x async for x in async_batch_exec([inner_timeout], timeout=timeout)]
+
+    for timeout in [None, 5]:
+        [(err, resp)] = asyncio.run(run_inner(timeout))
+        assert resp is None
+        assert str(err) == "Upstream timed out"
+        assert "Timed out after" not in err.stringify()
+
+    # The errors are detached like the 'catch_errors' ones.
+    set_detach_frames(True)
+    try:
+        results = asyncio.run(run(limit=3, timeout=0.5))
+    finally:
+        set_detach_frames(False)
+    errors = [err for err, _ in results if err]
+    assert len(errors) == 2
+    assert all(x.__traceback__ is None for err in errors for x in err.stack)
+
+
+def test_catch_errors_retry():
+    calls = []
+
+    @catch_errors(retry=RetryPolicy(max_attempts=4, base_delay=0))
+    def flaky(succeed_at):
+        calls.append(1)
+        if len(calls) < succeed_at:
+            raise ConnectionError(f"Attempt {len(calls)} failed")
+        return "ok"
+
+    assert flaky(3) == [None, "ok"]
+    assert len(calls) == 3
+
+    calls.clear()
+    err, resp = flaky(10)
+    assert resp is None
+    assert len(calls) == 4
+    assert [str(x) for x in err.stack] == [f"Attempt {i} failed" for i in range(1, 5)]
+
+    # Non-retryable errors fail on the first attempt.
+    calls.clear()
+
+    @catch_errors("Lookup failed", retry=RetryPolicy(base_delay=0, retry_on=KeyError))
+    def lookup():
+        calls.append(1)
+        raise ValueError("Bad key")
+
+    err, _ = lookup()
+    assert len(calls) == 1
+    assert [str(x) for x in err.stack] == ["Lookup failed", "Bad key"]
+
+    # The budget caps the retries across all the calls sharing it.
+    calls.clear()
+    budget = RetryBudget(rate=0.001, burst=2)
+    policy = RetryPolicy(
+        max_attempts=5, base_delay=0, retry_on=lambda x: True, budget=budget
+    )
+
+    @catch_errors(retry=policy)
+    def down():
+        calls.append(1)
+        raise Exception("Down")
+
+    down()
+    down()
+    assert len(calls) == 4
+
+
+def test_async_catch_errors_retry():
+    calls = []
+
+    @async_catch_errors(retry=RetryPolicy(max_attempts=3, base_delay=0.05))
+    async def flaky():
+        calls.append(1)
+        raise Exception("Failed")
+
+    async def ticker():
+        ticks = 0
+        while len(calls) < 3:
+            ticks += 1
+            await asyncio.sleep(0.005)
+        return ticks
+
+    async def run():
+        return await asyncio.gather(flaky(), ticker())
+
+    (err, _), ticks = asyncio.run(run())
+    assert len(err.stack) == 3
+    assert ticks > 0
+
+    assert RetryPolicy(base_delay=1, max_delay=2).delay(10) <= 2
+
+
+def test_circuit_breaker(capsys):
+    calls = []
+    healthy = [False]
+    breaker = CircuitBreaker(
+        name="users", failure_rate=0.5, min_calls=4, reset_timeout=0.05
+    )
+
+    @breaker("Failed to get user")
+    def get_user(user_id):
+        calls.append(user_id)
+        if not healthy[0]:
+            raise ConnectionError("Down")
+        return user_id
+
+    for i in range(4):
+        err, resp = get_user(i)
+        assert str(err.stack[1]) == "Down"
+    assert breaker.state == "open"
+
+    # Open: the calls fail immediately without calling the function.
+    calls.clear()
+    err, resp = get_user(5)
+    assert calls == [] and resp is None
+    assert str(err) == "Failed to get user"
+    assert isinstance(err.stack[1], CircuitOpenError)
+
+    # Half-open: a failed probe opens the circuit again.
+    time.sleep(0.06)
+    get_user(6)
+    assert calls == [6]
+    assert breaker.state == "open"
+
+    # Half-open: a successful probe closes it.
+    time.sleep(0.06)
+    healthy[0] = True
+    assert get_user(7) == [None, 7]
+    assert breaker.state == "closed"
+
+    lines = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    states = [x["data"]["state"] for x in lines if x.get("code") == "circuit_breaker"]
+    assert states == ["open", "half_open", "open", "half_open", "closed"]
+
+
+def test_async_circuit_breaker(capsys):
+    breaker = CircuitBreaker(min_calls=2, failure_on=KeyError, reset_timeout=10)
+
+    @breaker
+    async def fail(error):
+        raise error
+
+    async def run():
+        await fail(ValueError("Ignored"))
+        await fail(ValueError("Ignored"))
+        assert breaker.state == "closed"
+        await fail(KeyError("Counted"))
+        await fail(KeyError("Counted"))
+        return await fail(KeyError("Counted"))
+
+    err, _ = asyncio.run(run())
+    assert breaker.state == "open"
+    assert isinstance(err.stack[0], CircuitOpenError)
+
+
+def test_fingerprint():
+    @catch_errors("Failed to get user")
+    def get_user(user_id):
+        raise KeyError(f"User {user_id} (0x{user_id:x}) not found")
+
+    @catch_errors("Failed to get user")
+    def get_other_user(user_id):
+        raise KeyError(f"User {user_id} not found")
+
+    err_01, _ = get_user(1)
+    err_02, _ = get_user(123456)
+    err_03, _ = get_other_user(1)
+    assert err_01.fingerprint() == err_02.fingerprint()
+    assert err_01.fingerprint() != err_03.fingerprint()
+    assert e(err_01, "Retry failed").fingerprint() != err_01.fingerprint()
+    assert e("Failed 'abc'").fingerprint() == e("Failed 'def'").fingerprint()
+
+    # Stable across detach and serialization.
+    fingerprint = err_01.fingerprint()
+    assert pickle.loads(pickle.dumps(err_01)).fingerprint() == fingerprint
+    err_02.detach()
+    err_02._fingerprint = None
+    assert err_02.fingerprint() == fingerprint
+
+
+def test_catch_errors_generator():
+    # Without 'on_error', a generator function is called like any other function.
+    @catch_errors
+    def sizes(xs):
+        yield len(xs)
+
+    err, gen = sizes([1, 2])
+    assert err is None and list(gen) == [2]
+
+    pulled = []
+    calls = []
+
+    def numbers():
+        for i in range(6):
+            pulled.append(i)
+            yield i
+
+    @catch_errors("Failed to invert", on_error="stop")
+    def invert(items):
+        calls.append(1)
+        for i in items:
+            yield 1 / (i - 2)
+
+    @catch_errors(on_error="stop")
+    def twice(xs):
+        yield from xs
+        yield from xs
+
+    assert [x for _, x in twice([1, 2])] == [1, 2, 1, 2]
+
+    # Lazy: nothing is pulled before the consumer asks for it.
+    stream = invert(numbers())
+    assert pulled == []
+    assert next(stream) == [None, -0.5]
+    assert pulled == [0]
+
+    pulled.clear()
+    calls.clear()
+    results = list(invert(numbers()))
+    assert results[:2] == [[None, -0.5], [None, -1]]
+    err, item = results[2]
+    assert item is None and len(results) == 3
+    assert [str(x) for x in err.stack] == ["Failed to invert", "division by zero"]
+    assert pulled == [0, 1, 2]
+    assert len(calls) == 1
+
+    for policy in ["skip", "collect"]:
+        try:
+            catch_errors(on_error=policy)(numbers)
+            assert False
+        except Exception as error:
+            assert "Use 'item_fn' instead" in str(error)
+
+    try:
+        catch_errors(invert, on_error="retry")
+        assert False
+    except Exception as error:
+        assert "Invalid 'on_error' policy" in str(error)
+
+
+def test_catch_errors_item_fn():
+    def numbers():
+        yield from range(6)
+
+    def invert(i):
+        return 2 / (i - 2) if i % 2 == 0 else 2 / (i - 3)
+
+    # Skip the failed items. The errors are yielded in band with their item.
+    results = list(catch_errors(on_error="skip", item_fn=invert)(numbers()))
+    assert [x for _, x in results] == [-1, -1, 2, 3, 1, 1]
+    assert [x for err, x in results if err] == [2, 3]
+    assert str(results[2][0]) == "division by zero"
+
+    # Stop on the first error.
+    results = list(catch_errors("Failed", item_fn=invert)(numbers()))
+    assert [x for _, x in results] == [-1, -1, 2]
+    assert [str(x) for x in results[-1][0].stack] == ["Failed", "division by zero"]
+
+    # Collect the errors and yield them once the stream ends.
+    results = list(catch_errors(on_error="collect", item_fn=invert)(numbers()))
+    assert [x for _, x in results[:-1]] == [-1, -1, 1, 1]
+    err, _ = results[-1]
+    assert len(err.stack) == 2
+
+
+def test_async_catch_errors_generator():
+    async def numbers():
+        for i in range(4):
+            await asyncio.sleep(0)
+            yield i
+
+    async def parse(i):
+        if i == 1:
+            raise ValueError(f"Bad item {i}")
+        return i * 10
+
+    @async_catch_errors(on_error="stop")
+    async def parse_all(items):
+        for i in items:
+            if i == 2:
+                raise ValueError(f"Bad item {i}")
+            yield i * 10
+
+    async def run():
+        skip = async_catch_errors(on_error="skip", item_fn=parse)
+        skipped = [pair async for pair in skip(numbers())]
+        stopped = [pair async for pair in parse_all([0, 1, 2, 3])]
+        return skipped, stopped
+
+    skipped, stopped = asyncio.run(run())
+    assert [x for _, x in skipped] == [0, 1, 20, 30]
+    assert str(skipped[1][0]) == "Bad item 1"
+    assert [x for _, x in stopped] == [0, 10, None]
+    assert str(stopped[-1][0]) == "Bad item 2"
@@ -0,0 +1,169 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# - To skip a test, use this decoractor: @pytest.mark.skip() (doc: https://docs.pytest.org/en/latest/how-to/skipping.html)
+# - To only run a single test function, in the `makefile`, replace this command:
+#
+#       pytest --capture=no --verbose tests
+#
+#   with this:
+#
+#       pytest --capture=no --verbose tests/somemodule/test_some_test_name.py::test_self_describing_test_name
+
+# import pytest  # uncomment this line to use the 'pytest' decorators
+import sys
+import os
+import json
+import time
+import signal
+import tempfile
+import threading
+
+sys.path.append(".")  # noqa # Adds higher directory to python modules path.
+
+from src.puffy.log import (
+    log,
+    enable_async,
+    disable_async,
+    flush,
+    get_dropped_count,
+    set_sink,
+    FileSink,
+)
+from src.puffy.error import batch_exec
+
+
+class BlockingStream:
+    def __init__(self):
+        self.chunks = []
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+    def write(self, chunk):
+        self.entered.set()
+        self.release.wait(5)
+        self.chunks.append(chunk)
+
+    def flush(self):
+        pass
+
+    def lines(self):
+        return [json.loads(x) for x in "".join(self.chunks).splitlines()]
+
+
+def test_async_log_batches_writes(monkeypatch):
+    stream = BlockingStream()
+    stream.release.set()
+    monkeypatch.setattr(sys, "stdout", stream)
+
+    enable_async(queue_size=100, batch_size=10)
+    try:
+        for i in range(50):
+            log(message=f"msg {i}")
+        assert flush(timeout=5)
+    finally:
+        disable_async()
+
+    lines = stream.lines()
+    assert [x["message"] for x in lines] == [f"msg {i}" for i in range(50)]
+    assert len(stream.chunks) <= 50
+
+
+def _fill_while_blocked(monkeypatch, overflow):
+    stream = BlockingStream()
+    monkeypatch.setattr(sys, "stdout", stream)
+
+    enable_async(queue_size=2, batch_size=1, overflow=overflow)
+    try:
+        log(message="msg 0")
+        # Wait until the writer thread holds 'msg 0' so the queue is empty again.
+        assert stream.entered.wait(5)
+        for i in range(1, 6):
+            log(message=f"msg {i}")
+        dropped = get_dropped_count()
+        stream.release.set()
+        assert flush(timeout=5)
+    finally:
+        disable_async()
+
+    return dropped, [x["message"] for x in stream.lines()]
+
+
+def test_async_log_drop_newest(monkeypatch):
+    dropped, messages = _fill_while_blocked(monkeypatch, "drop_newest")
+    assert dropped == 3
+    assert messages == ["msg 0", "msg 1", "msg 2"]
+
+
+def test_async_log_drop_oldest(monkeypatch):
+    dropped, messages = _fill_while_blocked(monkeypatch, "drop_oldest")
+    assert dropped == 3
+    assert messages == ["msg 0", "msg 4", "msg 5"]
+
+
+def test_async_log_disable_drains_queue(monkeypatch):
+    stream = BlockingStream()
+    stream.release.set()
+    monkeypatch.setattr(sys, "stdout", stream)
+
+    enable_async(queue_size=1000, batch_size=7, overflow="block")
+    for i in range(100):
+        log(message=f"msg {i}")
+    disable_async()
+
+    assert len(stream.lines()) == 100
+
+
+def _log_in_child(i):
+    log(message=f"child {i}")
+    return flush(timeout=5)
+
+
+def _wait_child(pid, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return status
+        time.sleep(0.01)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return None
+
+
+def test_async_log_in_forked_child():
+    if not hasattr(os, "fork"):
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "app.log")
+        set_sink(FileSink(path))
+        enable_async(queue_size=2, batch_size=1)
+        try:
+            log(message="parent")
+            pid = os.fork()
+            if pid == 0:
+                # More lines than 'queue_size', so a dead writer would block.
+                status = 0
+                try:
+                    for i in range(5):
+                        log(message=f"fork {i}")
+                    status = 0 if flush(timeout=5) else 1
+                finally:
+                    os._exit(status)
+            assert _wait_child(pid, 10) == 0
+
+            results = list(batch_exec([(0,), (1,)], _log_in_child, executor="process"))
+            assert results == [(None, True), (None, True)]
+            assert flush(timeout=5)
+        finally:
+            disable_async()
+            set_sink(None)
+
+        with open(path) as file:
+            messages = sorted(json.loads(x)["message"] for x in file)
+    assert messages == sorted(
+        ["parent", "child 0", "child 1"] + [f"fork {i}" for i in range(5)]
+    )
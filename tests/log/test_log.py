@@ -18,11 +18,41 @@ import sys
 import json
 import re
 import os
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(".")  # noqa # Adds higher directory to python modules path.
 
-from src.puffy.log import log, set_context, reset_context, get_context
+from src.puffy.log import (
+    log,
+    set_context,
+    reset_context,
+    set_global_context,
+    reset_global_context,
+    get_context,
+    reload_meta,
+    log_context,
+    bind,
+    set_level,
+    get_level,
+    is_enabled,
+    set_rate_limit,
+    clear_rate_limits,
+    set_sink,
+    flush,
+    Sink,
+    enable_metric_aggregation,
+    disable_metric_aggregation,
+    flush_metrics,
+    enable_error_aggregation,
+    disable_error_aggregation,
+    flush_errors,
+    set_errors_format,
+)
 from src.puffy.error import catch_errors, StackedException as e
+from src.puffy.object import JSONView
 
 
 def test_basic_log():
@@ -150,6 +180,41 @@ def test_env_var_log():
     os.environ["LOG_META"] = ""
 
 
+def test_env_var_cached_log():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(msg)
+
+    os.environ["LOG_META"] = json.dumps({"api_name": "hello", "code": "meta"})
+    log(message="first", print_mock=print_mock)
+    log(message="second", code="03030303", print_mock=print_mock)
+
+    os.environ["LOG_META"] = json.dumps({"api_name": "world"})
+    log(message="third", print_mock=print_mock)
+
+    os.environ["LOG_META"] = "not json"
+    log(message="fourth", print_mock=print_mock)
+
+    assert logs[0] == json.dumps(
+        {"api_name": "hello", "code": "meta", "level": "INFO", "message": "first"}
+    )
+    # Keys explicitly passed to 'log' still override the meta keys.
+    assert logs[1] == json.dumps(
+        {"api_name": "hello", "code": "03030303", "level": "INFO", "message": "second"}
+    )
+    assert logs[2] == json.dumps(
+        {"api_name": "world", "level": "INFO", "message": "third"}
+    )
+    assert logs[3] == json.dumps({"level": "INFO", "message": "fourth"})
+
+    os.environ["LOG_META"] = json.dumps({"api_name": "reloaded"})
+    assert reload_meta() == {"api_name": "reloaded"}
+
+    os.environ["LOG_META"] = ""
+    assert reload_meta() == {}
+
+
 def test_incl_errors_log():
     @catch_errors("Should fail")
     def fail():
@@ -331,3 +396,568 @@ def test_reset_context():
     log(**input_01, print_mock=print_mock)
 
     assert logs[1] == json.dumps(input_01)
+
+
+def test_log_context():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(msg)
+
+    set_context(service="api")
+    with log_context(request_id=1):
+        log(message="one", print_mock=print_mock)
+        with log_context(request_id=2, user="Peter"):
+            log(message="two", print_mock=print_mock)
+            assert get_context() == {"service": "api", "request_id": 2, "user": "Peter"}
+        log(message="three", print_mock=print_mock)
+    log(message="four", print_mock=print_mock)
+    reset_context()
+
+    assert [json.loads(x) for x in logs] == [
+        {"service": "api", "request_id": 1, "level": "INFO", "message": "one"},
+        {
+            "service": "api",
+            "request_id": 2,
+            "user": "Peter",
+            "level": "INFO",
+            "message": "two",
+        },
+        {"service": "api", "request_id": 1, "level": "INFO", "message": "three"},
+        {"service": "api", "level": "INFO", "message": "four"},
+    ]
+
+
+def test_log_context_is_task_and_thread_local():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    @log_context(handler="async")
+    async def handle(request_id):
+        set_context(request_id=request_id)
+        await asyncio.sleep(0.01)
+        log(message=f"request {request_id}", print_mock=print_mock)
+
+    async def main():
+        await asyncio.gather(*[handle(i) for i in range(5)])
+
+    asyncio.run(main())
+
+    def handle_in_thread(request_id):
+        with log_context(request_id=request_id):
+            log(message=f"request {request_id}", print_mock=print_mock)
+
+    threads = [threading.Thread(target=handle_in_thread, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert get_context() == {}
+    assert len(logs) == 10
+    for item in logs:
+        assert item["message"] == f"request {item['request_id']}"
+    assert all(item["handler"] == "async" for item in logs[:5])
+
+
+def test_set_context_is_task_local():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    set_context(service="api")
+
+    async def handle(request_id):
+        set_context(request_id=request_id)
+        await asyncio.sleep(0.01)
+        log(message=f"request {request_id}", print_mock=print_mock)
+        reset_context()
+        assert get_context() == {"service": "api"}
+
+    async def main():
+        await asyncio.gather(*[handle(i) for i in range(3)])
+
+    asyncio.run(main())
+    assert get_context() == {"service": "api"}
+    reset_context()
+
+    assert sorted(x["request_id"] for x in logs) == [0, 1, 2]
+    for item in logs:
+        assert item["service"] == "api"
+        assert item["message"] == f"request {item['request_id']}"
+
+
+def test_set_context_is_process_wide_outside_a_scope():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    # Set at startup, before the worker threads exist.
+    set_context(service="api")
+
+    def handle(request_id):
+        with log_context(request_id=request_id):
+            set_context(step="handle")
+            log(message=f"request {request_id}", print_mock=print_mock)
+        log(message="done", print_mock=print_mock)
+
+    thread = threading.Thread(target=handle, args=(0,))
+    thread.start()
+    thread.join()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(handle, [1, 2]))
+
+    assert get_context() == {"service": "api"}
+    reset_context()
+    assert get_context() == {}
+
+    assert len(logs) == 6
+    assert all(item["service"] == "api" for item in logs)
+    for item in logs:
+        if item["message"] == "done":
+            assert item == {"service": "api", "level": "INFO", "message": "done"}
+        else:
+            assert item["message"] == f"request {item['request_id']}"
+            assert item["step"] == "handle"
+
+    # The explicit API always sets the process-wide context.
+    with log_context(request_id=1):
+        set_global_context(region="us")
+        assert get_context() == {"region": "us", "request_id": 1}
+    assert get_context() == {"region": "us"}
+    reset_global_context()
+    assert get_context() == {}
+
+
+def test_bind():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(msg)
+
+    logger = bind(code="03030303", op_id="1234", print_mock=print_mock)
+    child = logger.bind(service="api")
+
+    logger.log(message="one")
+    child.log(level="WARN", message="two", data={"hello": "world"})
+    child.log(message="three", code="override")
+    with log_context(request_id=1):
+        child.log(message="four")
+
+    assert logger.fields == {"code": "03030303", "op_id": "1234"}
+    assert child.fields == {"code": "03030303", "op_id": "1234", "service": "api"}
+    assert logs[0] == json.dumps(
+        {"code": "03030303", "op_id": "1234", "level": "INFO", "message": "one"}
+    )
+    assert logs[1] == json.dumps(
+        {
+            "code": "03030303",
+            "op_id": "1234",
+            "service": "api",
+            "level": "WARN",
+            "message": "two",
+            "data": {"hello": "world"},
+        }
+    )
+    assert logs[2] == json.dumps(
+        {
+            "code": "override",
+            "op_id": "1234",
+            "service": "api",
+            "level": "INFO",
+            "message": "three",
+        }
+    )
+    assert logs[3] == json.dumps(
+        {
+            "request_id": 1,
+            "code": "03030303",
+            "op_id": "1234",
+            "service": "api",
+            "level": "INFO",
+            "message": "four",
+        }
+    )
+
+
+def test_level_threshold():
+    logs = []
+    calls = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    def expensive():
+        calls.append(1)
+        return {"hello": "world"}
+
+    set_level("warning")
+    try:
+        assert get_level() == "WARN"
+        assert not is_enabled("INFO")
+        assert is_enabled("error")
+        log(message="muted", data=expensive, print_mock=print_mock)
+        bind(print_mock=print_mock).log(message="muted", data=expensive)
+        log(
+            level="error", message=lambda: "kept", data=expensive, print_mock=print_mock
+        )
+    finally:
+        set_level()
+
+    assert calls == [1]
+    assert logs == [{"level": "ERROR", "message": "kept", "data": {"hello": "world"}}]
+
+    os.environ["LOG_LEVEL"] = "CRITICAL"
+    set_level()
+    assert get_level() == "CRITICAL"
+    os.environ["LOG_LEVEL"] = ""
+    set_level()
+    assert get_level() == "INFO"
+
+
+class ListSink(Sink):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def write_lines(self, lines):
+        self.lines.extend(json.loads(x) for x in lines)
+
+    def write(self, data):
+        self.write_lines(data.decode("utf-8").splitlines())
+
+
+def test_rate_limit():
+    sink = ListSink()
+    set_sink(sink)
+    try:
+        set_rate_limit(code="hot", rate=0.001, burst=3)
+        set_rate_limit(level="INFO", sample=0)
+        for i in range(10):
+            log(level="ERROR", code="hot", message=f"hot {i}")
+            log(level="ERROR", code="cold", message=f"cold {i}")
+        bind(code="hot").log(level="ERROR", message="bound")
+        log(level="INFO", message="sampled out")
+        log(level="WARN", message="kept")
+        flush()
+
+        hot = [x for x in sink.lines if x.get("message", "").startswith("hot")]
+        cold = [x for x in sink.lines if x.get("message", "").startswith("cold")]
+        summaries = [x for x in sink.lines if "suppressed" in x.get("data", {})]
+        assert len(hot) == 3
+        assert len(cold) == 10
+        assert not [x for x in sink.lines if x["message"] in ["bound", "sampled out"]]
+        assert [x for x in sink.lines if x["message"] == "kept"]
+        assert sorted((x["data"]["suppressed"], x["message"]) for x in summaries) == [
+            (1, "suppressed 1 lines for level INFO"),
+            (8, "suppressed 8 lines for code hot"),
+        ]
+
+        clear_rate_limits()
+        log(level="ERROR", code="hot", message="hot again")
+        assert sink.lines[-1]["message"] == "hot again"
+
+        # The summaries are logged on a timer, without any other log or flush.
+        del sink.lines[:]
+        set_rate_limit(code="burst", rate=0.001, burst=1, summary_interval=0.1)
+        for i in range(5):
+            log(code="burst", message=f"burst {i}")
+        time.sleep(0.3)
+        assert [x["message"] for x in sink.lines] == [
+            "burst 0",
+            "suppressed 4 lines for code burst",
+        ]
+    finally:
+        clear_rate_limits()
+        set_sink(None)
+
+
+def test_metric_aggregation():
+    sink = ListSink()
+    set_sink(sink)
+    try:
+        enable_metric_aggregation(
+            interval=None, namespace="tests", dimensions=["service"], buckets=[10, 100]
+        )
+        for value in [1, 5, 50, 500]:
+            log(code="latency", time=value, service="api")
+        bind(service="db").log(code="latency", time=20)
+        log(code="size", metric=3, unit="bytes")
+        log(message="not a metric")
+        # Only the records with nothing but the metric are folded.
+        log(level="ERROR", code="latency", time=50, errors=Exception("boom"))
+        log(code="latency", time=50, message="slow query")
+        log(level="WARN", code="latency", time=50)
+        log(code="latency", time=50, data={"query": "select"})
+        log(code="latency", time=50, user="Peter")
+
+        assert [x.get("message") for x in sink.lines] == [
+            "not a metric",
+            None,
+            "slow query",
+            None,
+            None,
+            None,
+        ]
+        assert sink.lines[1]["level"] == "ERROR"
+        assert sink.lines[1]["metric"] == 50
+        assert sink.lines[3]["level"] == "WARN"
+        assert sink.lines[5]["user"] == "Peter"
+        del sink.lines[:]
+        flush_metrics()
+    finally:
+        disable_metric_aggregation()
+        set_sink(None)
+
+    records = {(x["code"], x.get("service")): x for x in sink.lines}
+    assert len(records) == 3
+
+    api = records[("latency", "api")]
+    assert api["stats"] == {"count": 4, "sum": 556, "min": 1, "max": 500}
+    assert "metric" not in api
+    assert api["unit"] == "ms"
+    assert api["latency"] == {"Values": [3, 50, 500], "Counts": [2, 1, 1]}
+    assert api["_aws"]["CloudWatchMetrics"] == [
+        {
+            "Namespace": "tests",
+            "Dimensions": [["service"]],
+            "Metrics": [{"Name": "latency", "Unit": "Milliseconds"}],
+        }
+    ]
+
+    assert records[("latency", "db")]["stats"]["count"] == 1
+    size = records[("size", None)]
+    assert size["size"] == {"Values": [3], "Counts": [1]}
+    assert size["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [[]]
+    assert size["_aws"]["CloudWatchMetrics"][0]["Metrics"][0]["Unit"] == "Bytes"
+
+
+def test_timed():
+    logs = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    logger = bind(service="api", print_mock=print_mock)
+
+    with logger.timed(code="block"):
+        pass
+
+    @logger.timed(code="sync_fn", message="done")
+    def sync_fn(x):
+        if x:
+            raise Exception("Boom")
+        return "ok"
+
+    @logger.timed(code="async_fn", level="WARN")
+    async def async_fn():
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    assert sync_fn(False) == "ok"
+    try:
+        sync_fn(True)
+        assert False
+    except Exception as error:
+        assert str(error) == "Boom"
+    assert asyncio.run(async_fn()) == "ok"
+
+    set_level("ERROR")
+    try:
+        with logger.timed(code="muted"):
+            pass
+    finally:
+        set_level()
+
+    assert [(x["code"], x["success"]) for x in logs] == [
+        ("block", True),
+        ("sync_fn", True),
+        ("sync_fn", False),
+        ("async_fn", True),
+    ]
+    for item in logs:
+        assert item["service"] == "api"
+        assert item["unit"] == "ms"
+        assert isinstance(item["metric"], float)
+    assert logs[1]["message"] == "done"
+    # Failures are logged at the ERROR level, with their trace.
+    assert logs[2]["level"] == "ERROR"
+    assert "Boom" in logs[2]["errors"]
+    assert "in sync_fn" in logs[2]["errors"]
+    assert logs[3]["level"] == "WARN"
+    assert logs[3]["metric"] >= 10
+
+    # A muted timer does not measure anything, but its failures are logged.
+    del logs[:]
+    set_level("ERROR")
+    try:
+        with logger.timed(code="muted"):
+            pass
+        try:
+            sync_fn(True)
+        except Exception:
+            pass
+    finally:
+        set_level()
+    assert len(logs) == 1
+    assert logs[0]["level"] == "ERROR"
+    assert logs[0]["success"] is False
+    assert "metric" not in logs[0]
+
+    # The same timer can be entered again while it is running.
+    del logs[:]
+    timer = logger.timed(code="nested")
+    with timer:
+        with timer:
+            pass
+    assert [x["code"] for x in logs] == ["nested", "nested"]
+    assert logs[1]["metric"] >= logs[0]["metric"]
+
+    # A reused timer measures each task and thread on its own.
+    del logs[:]
+    shared = logger.timed(code="shared")
+
+    async def task(delay, seconds):
+        await asyncio.sleep(delay)
+        with shared:
+            await asyncio.sleep(seconds)
+
+    async def main():
+        await asyncio.gather(task(0, 0.05), task(0.02, 0.2))
+
+    asyncio.run(main())
+
+    def work(delay, seconds):
+        time.sleep(delay)
+        with shared:
+            time.sleep(seconds)
+
+    threads = [threading.Thread(target=work, args=x) for x in [(0, 0.05), (0.02, 0.2)]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    metrics = [x["metric"] for x in logs]
+    for short, long in [metrics[:2], metrics[2:]]:
+        assert 50 <= short < 190
+        assert 200 <= long < 400
+
+    # With aggregation, only the successful plain timings are folded.
+    del logs[:]
+    enable_metric_aggregation(interval=None)
+    try:
+        with logger.timed(code="block"):
+            pass
+        assert sync_fn(False) == "ok"
+        try:
+            sync_fn(True)
+        except Exception:
+            pass
+        assert [(x["code"], x["success"]) for x in logs] == [
+            ("sync_fn", True),
+            ("sync_fn", False),
+        ]
+    finally:
+        disable_metric_aggregation()
+
+
+def test_structured_errors():
+    @catch_errors("Should fail")
+    def fail():
+        raise ValueError("Failed")
+
+    err, _ = fail()
+    logs = []
+
+    def print_mock(msg):
+        logs.append(json.loads(msg))
+
+    set_errors_format("structured")
+    try:
+        log(level="ERROR", errors=err, print_mock=print_mock)
+        log(level="ERROR", errors=["Bim bam boom", err], print_mock=print_mock)
+    finally:
+        set_errors_format()
+    log(level="ERROR", errors=err, print_mock=print_mock)
+
+    errors = logs[0]["errors"]
+    assert [(x["type"], x["message"]) for x in errors] == [
+        ("Exception", "Should fail"),
+        ("ValueError", "Failed"),
+    ]
+    assert errors[0]["function"]["name"] == "fail"
+    assert errors[1]["frames"][-1]["function"] == "fail"
+    assert (
+        logs[1]["errors"]
+        == [{"type": None, "message": "Bim bam boom", "frames": []}] + errors
+    )
+    assert logs[2]["errors"] == err.stringify()
+
+
+def test_error_aggregation():
+    @catch_errors("Failed to get user")
+    def get_user(user_id):
+        raise KeyError(f"user_{user_id}")
+
+    @catch_errors("Failed to get order")
+    def get_order(order_id):
+        raise KeyError(f"order_{order_id}")
+
+    sink = ListSink()
+    set_sink(sink)
+    try:
+        enable_error_aggregation(window=None)
+        for i in range(5):
+            log(level="ERROR", code="user", errors=get_user(i)[0])
+        log(level="WARN", code="order", errors=get_order(1)[0])
+        log(level="WARN", errors="Disk 1 is full")
+        log(level="WARN", errors="Disk 2 is full")
+        log(message="No errors")
+
+        assert len(sink.lines) == 4
+        user, order, disk = sink.lines[:3]
+        assert "user_0" in user["errors"]
+        assert user["fingerprint"] != order["fingerprint"]
+        assert disk["errors"] == "Disk 1 is full"
+        assert "fingerprint" not in sink.lines[3]
+
+        flush_errors()
+        summaries = sink.lines[4:]
+        assert summaries == [
+            {
+                "level": "ERROR",
+                "message": f"4 more occurrences of error {user['fingerprint']}",
+                "code": "user",
+                "fingerprint": user["fingerprint"],
+                "count": 4,
+            },
+            {
+                "level": "WARN",
+                "message": f"1 more occurrences of error {disk['fingerprint']}",
+                "fingerprint": disk["fingerprint"],
+                "count": 1,
+            },
+        ]
+
+        # A new window logs the full error again.
+        log(level="ERROR", code="user", errors=get_user(6)[0])
+        assert "user_6" in sink.lines[-1]["errors"]
+    finally:
+        disable_error_aggregation()
+        set_sink(None)
+
+
+def test_log_json_view():
+    logs = []
+    view = JSONView({"user": {"name": "Nic", "roles": ["admin"]}})
+    log(data=view["user"], roles=view["user"]["roles"], print_mock=logs.append)
+    assert json.loads(logs[0]) == {
+        "level": "INFO",
+        "roles": ["admin"],
+        "data": {"name": "Nic", "roles": ["admin"]},
+    }
@@ -0,0 +1,161 @@
+# Copyright (c) 2019-2023, Cloudless Consulting Pty Ltd.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# - To skip a test, use this decoractor: @pytest.mark.skip() (doc: https://docs.pytest.org/en/latest/how-to/skipping.html)
+# - To only run a single test function, in the `makefile`, replace this command:
+#
+#       pytest --capture=no --verbose tests
+#
+#   with this:
+#
+#       pytest --capture=no --verbose tests/somemodule/test_some_test_name.py::test_self_describing_test_name
+
+# import pytest  # uncomment this line to use the 'pytest' decorators
+import sys
+import json
+import os
+import socket
+import select
+import tempfile
+
+sys.path.append(".")  # noqa # Adds higher directory to python modules path.
+
+from src.puffy.log import (
+    log,
+    flush,
+    set_sink,
+    enable_async,
+    disable_async,
+    StdoutSink,
+    FileSink,
+    UnixSocketSink,
+    Sink,
+)
+
+
+def test_file_sink():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "app.log")
+        set_sink(FileSink(path, buffer_size=1024))
+        try:
+            log(message="hello")
+            log(message="world")
+            flush()
+        finally:
+            set_sink(None).close()
+
+        with open(path, "rb") as f:
+            lines = f.read().splitlines()
+
+    assert [json.loads(x)["message"] for x in lines] == ["hello", "world"]
+
+
+def test_file_sink_size_rotation():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "app.log")
+        sink = FileSink(path, max_bytes=100, backup_count=2)
+        for i in range(10):
+            sink.write_lines([json.dumps({"message": f"msg {i:02}", "padding": 20})])
+        sink.close()
+
+        files = sorted(os.listdir(folder))
+        assert files == ["app.log", "app.log.1", "app.log.2"]
+        for name in files:
+            assert os.path.getsize(os.path.join(folder, name)) <= 100
+
+        with open(path, "rb") as f:
+            assert json.loads(f.read().splitlines()[-1])["message"] == "msg 09"
+
+
+def test_stdout_sink():
+    read_fd, write_fd = os.pipe()
+    try:
+        sink = StdoutSink(fd=write_fd, buffer_size=4096)
+        sink.write_lines(["a", "b"])
+        sink.write_lines(["c"])
+        sink.flush()
+        assert os.read(read_fd, 1024) == b"a\nb\nc\n"
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_buffered_sink_flush_interval():
+    read_fd, write_fd = os.pipe()
+    try:
+        held = StdoutSink(fd=write_fd, buffer_size=4096, flush_interval=None)
+        held.write_lines(["held"])
+        sink = StdoutSink(fd=write_fd, buffer_size=4096, flush_interval=0.05)
+        sink.write_lines(["a", "b"])
+        # Written by the timer, without 'flush' and with a buffer far from full.
+        ready, _, _ = select.select([read_fd], [], [], 5)
+        assert ready
+        assert os.read(read_fd, 1024) == b"a\nb\n"
+        sink.close()
+        held.close()
+        assert os.read(read_fd, 1024) == b"held\n"
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_sink_without_write():
+    class NoWriteSink(Sink):
+        def flush(self):
+            pass
+
+    try:
+        NoWriteSink()
+        assert False
+    except TypeError as error:
+        assert "write" in str(error)
+
+
+def test_unix_dgram_socket_sink():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "collector.sock")
+        collector = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        collector.bind(path)
+        collector.settimeout(5)
+        try:
+            set_sink(UnixSocketSink(path))
+            enable_async(batch_size=10)
+            try:
+                for i in range(3):
+                    log(message=f"msg {i}")
+                flush()
+            finally:
+                disable_async()
+                set_sink(None).close()
+
+            messages = [json.loads(collector.recv(4096))["message"] for _ in range(3)]
+        finally:
+            collector.close()
+
+    assert messages == ["msg 0", "msg 1", "msg 2"]
+
+
+def test_unix_stream_socket_sink():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "collector.sock")
+        collector = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        collector.bind(path)
+        collector.listen(1)
+        collector.settimeout(5)
+        try:
+            sink = UnixSocketSink(path, kind="stream")
+            sink.write_lines(['{"a": 1}', '{"b": 2}'])
+            conn, _ = collector.accept()
+            conn.settimeout(5)
+            data = b""
+            while data.count(b"\n") < 2:
+                data += conn.recv(4096)
+            conn.close()
+            sink.close()
+        finally:
+            collector.close()
+
+    assert data == b'{"a": 1}\n{"b": 2}\n'
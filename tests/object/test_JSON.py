@@ -15,10 +15,25 @@
 
 # import pytest  # uncomment this line to use the 'pytest' decorators
 import sys
+import copy
+import math
+import json
+from array import array
+from types import MappingProxyType
 
 sys.path.append(".")  # noqa # Adds higher directory to python modules path.
 
-from src.puffy.object import JSON, dotProps
+from src.puffy.object import (
+    JSON,
+    dotProps,
+    compile_path,
+    compile_paths,
+    extract_columns,
+    unwrap,
+    JSONView,
+    JSONListView,
+    DotPath,
+)
 
 
 def test_query_keys():
@@ -46,7 +61,9 @@ def test_query_JSON_dot_keys():
     assert len(obj.g("hello.address")) == 3
     assert obj.g("hello.address")[0] == "no"
     assert obj.g("hello.address.line1") is None
-    assert isinstance(obj.g("hello.address"), dict)
+    assert isinstance(obj.g("hello.address"), list)
+    assert obj.g("hello.address.line1", vivify=True) is None
+    assert obj.g("hello.address") == ["no", 1, "street"]
 
 
 def test_query_dot_keys():
@@ -55,3 +72,283 @@ def test_query_dot_keys():
     assert dotProps(obj, "hello.default") == "world"
     assert not dotProps(obj, "hello.something.else")
     assert dotProps(obj, "name") == "Nic"
+
+
+def test_read_does_not_mutate():
+    config = {"db": {"host": "localhost", "port": None}, "tags": ["a"]}
+    frozen = MappingProxyType(config)
+    snapshot = copy.deepcopy(config)
+
+    assert dotProps(config, "db.host") == "localhost"
+    assert dotProps(config, "db.user.name", default="admin") == "admin"
+    assert dotProps(config, "tags.first", default=0) == 0
+    assert dotProps(config, "db.port", default=5432) is None
+    assert dotProps(frozen, "db.host") == "localhost"
+    assert JSON(config).g("db.password", default="") == ""
+    assert compile_path("db.user").has(frozen) is False
+    assert config == snapshot
+
+    assert dotProps(config, "db.user.name", vivify=True) is None
+    assert config["db"]["user"] == {"name": None}
+
+
+def test_compile_path():
+    path = compile_path("hello.address.line1")
+    assert path is compile_path("hello.address.line1")
+    assert path.keys == ("hello", "address", "line1")
+
+    obj = {"hello": {"address": {"line1": "Magic street"}}, "name": "Nic"}
+    assert path.has(obj)
+    assert path.get(obj) == "Magic street"
+    assert path.set(obj, "Other street") == "Other street"
+    assert obj["hello"]["address"]["line1"] == "Other street"
+
+    other = compile_path("name.first")
+    assert not other.has(obj)
+    assert other.get(obj) is None
+    assert obj["name"] == "Nic"
+    assert other.get(obj, vivify=True) is None
+    assert obj["name"] == {"first": None}
+    assert compile_path("person.name").set({}, "Peter") == "Peter"
+    assert compile_path("a").get([]) is None
+
+    try:
+        DotPath("")
+        assert False
+    except Exception as error:
+        assert str(error) == "'path' must be a non-empty string."
+
+
+def test_many_paths():
+    event = JSON(
+        {
+            "request": {
+                "headers": {"host": "example.com", "user-agent": "curl"},
+                "method": "GET",
+            },
+            "status": 200,
+        }
+    )
+    paths = [
+        "request.headers.host",
+        "request.headers.user-agent",
+        "request.headers.cookie",
+        "request.method",
+        "request.method.name",
+        "status",
+    ]
+
+    assert event.g_many(paths, default="") == {
+        "request.headers.host": "example.com",
+        "request.headers.user-agent": "curl",
+        "request.headers.cookie": "",
+        "request.method": "GET",
+        "request.method.name": "",
+        "status": 200,
+    }
+    assert list(event.g_many(paths)) == paths
+    assert "cookie" not in event["request"]["headers"]
+
+    # The compiled paths can be reused across documents.
+    trie = compile_paths(paths)
+    assert trie is compile_paths(tuple(paths))
+    assert trie.get({"status": 404})["status"] == 404
+    assert trie.get(None)["status"] is None
+
+    values = {
+        "request.method": "POST",
+        "request.body.size": 12,
+        "response": "ok",
+        "response.status": 201,
+    }
+    assert event.s_many(values) is values
+    assert event["request"]["method"] == "POST"
+    assert event["request"]["body"] == {"size": 12}
+    assert event["response"] == {"status": 201}
+    assert event.g("request.headers.host") == "example.com"
+
+
+def test_list_indexes_and_wildcards():
+    order = JSON(
+        {
+            "items": [
+                {"sku": "a", "price": 10, "tags": ["new"]},
+                {"sku": "b", "price": 20},
+                {"sku": "c", "tags": ["sale", "new"]},
+            ],
+            "totals": {"net": 30, "tax": 3},
+            "0": "zero",
+        }
+    )
+
+    assert order.g("items.0.price") == 10
+    assert order.g("items.-1.sku") == "c"
+    assert order.g("items.5.price", default=0) == 0
+    assert order.g("items.sku") is None
+    assert order.g("0") == "zero"
+    assert order.g("items.*.price") == [10, 20]
+    assert order.g("items.*.tags.*") == ["new", "sale", "new"]
+    assert order.g("totals.*") == [30, 3]
+    assert order.g("missing.*") == []
+    assert compile_path("items.*.tags").has(order)
+    assert not compile_path("items.*.discount").has(order)
+    assert compile_path("items.2.sku").has(order)
+    assert not compile_path("items.3").has(order)
+
+    # Writing through lists does not replace them.
+    assert order.s("items.1.price", 25) == 25
+    assert order.s("items.*.currency", "AUD") == "AUD"
+    assert order.s("items.0.tags.0", "old") == "old"
+    assert isinstance(order["items"], list)
+    assert [x["currency"] for x in order["items"]] == ["AUD"] * 3
+    assert order["items"][1]["price"] == 25
+    assert order["items"][0]["tags"] == ["old"]
+    assert order.g("items.0.size.width", vivify=True) is None
+    assert order["items"][0]["size"] == {"width": None}
+
+    # A list is never replaced by a dict.
+    items = copy.deepcopy(order["items"])
+    assert order.s("items.5.price", 9) is None
+    assert order.s("items.price", 9) is None
+    assert order.s("items.-4.price", 9) is None
+    assert order.g("items.price.value", vivify=True) is None
+    assert order.s_many({"items.price": 9}) is not None
+    assert order["items"] == items
+
+    # Several paths at once.
+    assert order.g_many(["items.0.sku", "items.*.sku", "totals.net"]) == {
+        "items.0.sku": "a",
+        "items.*.sku": ["a", "b", "c"],
+        "totals.net": 30,
+    }
+    order.s_many({"items.2.price": 5, "totals.net": 60})
+    assert order.g("items.*.price") == [10, 25, 5]
+
+    # Only the decimal keys are list indexes.
+    obj = JSON({"a": {"²": 1, "-²": 2}})
+    assert obj.g("a.²") == 1
+    assert obj.g("a.-²") == 2
+    assert obj.s("a.²", 3) == 3
+
+
+def test_extract_columns():
+    documents = (
+        {"id": i, "user": {"name": f"user_{i}"}, "items": [{"price": i}] * (i % 3)}
+        for i in range(5)
+    )
+    batches = list(
+        extract_columns(
+            documents,
+            ["id", "user.name", "items.*.price", "score"],
+            batch_size=2,
+            types={"id": "q", "score": "d"},
+            defaults={"id": -1},
+            numpy=False,
+        )
+    )
+
+    assert len(batches) == 3
+    assert [len(x["id"]) for x in batches] == [2, 2, 1]
+    first = batches[0]
+    assert first["id"] == array("q", [0, 1])
+    assert first["user.name"] == ["user_0", "user_1"]
+    assert first["items.*.price"] == [[], [1]]
+    assert all(math.isnan(x) for x in first["score"])
+
+    [single] = extract_columns([], ["id"], numpy=False)
+    assert single == {"id": []}
+    batches = list(extract_columns([{"id": 1}] * 4, ["id"], batch_size=2))
+    assert [x["id"] for x in batches] == [[1, 1], [1, 1]]
+
+    # The default batches are bounded.
+    batches = list(extract_columns(({"id": i} for i in range(10001)), ["id"]))
+    assert [len(x["id"]) for x in batches] == [10000, 1]
+
+    # The shared keys are read once for all the paths that use them.
+    documents = [
+        {"user": {"name": "Nic", "age": None}, "tags": ["a", "b"]},
+        {"user": "Nic", "tags": "a"},
+        JSON({"user": JSON({"name": "Jo"})}),
+    ]
+    [batch] = extract_columns(
+        documents, ["user", "user.name", "user.age", "tags.1"], default="?"
+    )
+    assert batch["user.name"] == ["Nic", "?", "Jo"]
+    assert batch["user.age"] == [None, "?", "?"]
+    assert batch["tags.1"] == ["b", "?", "?"]
+    assert batch["user"][1] == "Nic"
+    assert documents[2] == {"user": {"name": "Jo"}}
+
+    try:
+        next(extract_columns([{}], ["id"], batch_size=None))
+        assert False
+    except Exception as error:
+        assert str(error) == "'batch_size' must be a strictly positive integer."
+
+    try:
+        next(extract_columns([{}], ["id"], types={"id": "q"}, numpy=False))
+        assert False
+    except Exception as error:
+        assert str(error) == "Missing 'default' value for the integer column 'id'."
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is None:
+        try:
+            next(extract_columns([{}], ["id"], numpy=True))
+            assert False
+        except Exception as error:
+            assert "NumPy is not installed" in str(error)
+    else:
+        [batch] = extract_columns(
+            [{"id": 1}, {"id": 2}], ["id"], types={"id": "d"}, numpy=True
+        )
+        assert isinstance(batch["id"], numpy.ndarray)
+        assert batch["id"].tolist() == [1.0, 2.0]
+
+
+def test_json_view():
+    raw = {"user": {"name": "Nic", "roles": [{"name": "admin"}, "guest"]}, "n": 1}
+    view = JSONView(raw)
+
+    # Nothing is copied and the nested views are cached.
+    assert view.unwrap() is raw
+    assert unwrap(view) is raw
+    assert view["user"] is view["user"]
+    assert view["user"].unwrap() is raw["user"]
+    assert isinstance(view["user"]["roles"], JSONListView)
+    assert view["user"]["roles"][0]["name"] == "admin"
+    assert view["user"]["roles"][-1] == "guest"
+    assert [x for x in view["user"]["roles"]][0] is view["user"]["roles"][0]
+
+    # Same auto-vivification as 'JSON', written to the underlying dict.
+    view["address"]["line1"] = "Magic street"
+    assert raw["address"] == {"line1": "Magic street"}
+    assert view.get("phone") is None and "phone" not in raw
+    assert "address" in view and len(view) == 3
+
+    # Views are stored unwrapped and stale cached views are dropped.
+    view["copy"] = view["user"]
+    assert raw["copy"] is raw["user"]
+    raw["user"] = {"name": "Peter"}
+    assert view["user"]["name"] == "Peter"
+    view["user"]["roles"] = JSONListView([1])
+    view["user"]["roles"].append(2)
+    del view["copy"]
+    assert raw["user"] == {"name": "Peter", "roles": [1, 2]}
+    assert view == raw
+
+    assert view.g("user.roles.1") == 2
+    assert view.s("user.age", 42) == 42
+    assert view.g_many(["user.age", "n"]) == {"user.age": 42, "n": 1}
+    assert raw["user"]["age"] == 42
+
+    assert json.dumps(view, default=unwrap) == json.dumps(raw)
+    try:
+        json.dumps({"view": view, "other": object()}, default=unwrap)
+        assert False
+    except TypeError as error:
+        assert str(error) == "Object of type object is not JSON serializable"